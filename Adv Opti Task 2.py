@@ -67,18 +67,34 @@ blocker, non_ESD_venue, block_start, block_end = gp.multidict({
 
 print("\nConverted csv data into multidict")
 
+### Preprocessing: feasible start times ####################################
+# A job may only start in its own venue (j=>v), at a time-index where it does not
+# run into an EOD or HASS block (B6), and not where its venue is blocked by another
+# pillar (B5). X is only created for these, so those constraints need no rows.
+def feasible_starts(j):
+	blocked = set()
+	for t in EOD_timings + HASS_block_timings:
+		blocked.update(range(max(1,t-proc[j]+1), t+1))
+	for b in blocker:
+		if non_ESD_venue[b] == venue[j]:
+			blocked.update(range(block_start[b], block_end[b]+1))
+	return [t for t in range(1,T+1) if t not in blocked]
+
 ### Define variables & objective function ###################################
-completion_time = {(j,v,t): t + proc[j] for j in jobs for v in set(venue.values()) for t in range(1,T+1)}
+time0 = time.time() # to check solution time
 
-print("Problem space: %d ESD jobs x %d venues x %d time indices = %d\n"
-% (len(jobs), len(set(venue.values())), T, len(jobs)*len(set(venue.values()))*T))
+completion_time = {(j,venue[j],t): t + proc[j] for j in jobs for t in feasible_starts(j)}
+full_space = len(jobs)*len(set(venue.values()))*T
+
+print("Problem space: %d ESD jobs x %d venues x %d time indices = %d"
+% (len(jobs), len(set(venue.values())), T, full_space))
+print("Variables created for assigned venues and feasible start times only: %d (%d fewer, %.1f%% of the full space)\n"
+% (len(completion_time), full_space-len(completion_time), 100*len(completion_time)/full_space))
 
 print("Creating Gurobi model:")
 m = gp.Model("Adv Opti Task 2 by Kutosotase 2021")
 X = m.addVars(completion_time.keys(), vtype=GRB.BINARY, name="X")
 
-time0 = time.time() # to check solution time
-
 # Variables to ensure classes of a subject are spread out across days
 EOD_splits = [(j,k,t) for j in jobs for k in jobs for t in range(4)]
 E = m.addVars(EOD_splits, vtype=GRB.BINARY, name="E")
@@ -106,12 +122,14 @@ m.addConstrs((X.sum(j,"*","*")==1 for j in jobs), "all jobs assigned")
 
 ### B2: At most 1 class at any venue at any time instant
 for v in set(venue.values()):
+	jobs_at_venue = [j for j in jobs if venue[j]==v]
 	for t in range(1,T+1):
-		jobs_in_venue = 0
-		for j in jobs:
+		jobs_in_venue = gp.LinExpr()
+		for j in jobs_at_venue:
 			for s in range(max(1,t+1-proc[j]), t+1):
-				jobs_in_venue += X[j,v,s]
-		m.addConstr(jobs_in_venue <= 1, "<=1 job per venue per time")
+				jobs_in_venue += X.get((j,v,s), 0)
+		if jobs_in_venue.size() > 0:
+			m.addConstr(jobs_in_venue <= 1, "<=1 job per venue per time")
 
 ### B3: At most 1 class per instructor at any time instant
 for instr in set(instructor.values()):
@@ -126,16 +144,8 @@ for instr in set(instructor.values()):
 		m.addConstr(jobs_being_done <= 1, "<=1 job per prof per time")
 
 ### B5: Venues are blocked by other pillars/HASS
-for v in set(venue.values()):
-	for b in blocker:
-		if v == non_ESD_venue[b]:
-			m.addConstrs((X.sum("*",v,t)==0 for t in range(block_start[b], block_end[b]+1)), "venues blocked by other pillars")
-
 ### B6: Time slots are blocked by EOD and the blanket block period for HASS
-for t in EOD_timings:
-	m.addConstrs((X.sum(j,"*",s)==0 for j in jobs for s in range(max(1,t-proc[j]+1), t+1)), "time blocked by EOD")
-for t in HASS_block_timings:
-	m.addConstrs((X.sum(j,"*",s)==0 for j in jobs for s in range(max(1,t-proc[j]+1), t+1)), "time blocked for HASS")
+# Enforced in preprocessing: X has no variables for blocked start times
 
 ### B4 & A2: Precedence constraints within the same subject & At most one session of each subject in a day
 lecture_str = re.compile("L")
@@ -161,9 +171,7 @@ for key, vals in venue_overlap.items():
 		m.addConstrs((X.sum("*",key,t)+(X.sum("*",val,t))<=1 for t in range(1,T+1)), "venue overlaps")
 
 ### j=>v: Sessions must occupy the venue stipulated in the original timetable
-for j in jobs:
-	for v in set(venue.values()):
-		m.addConstrs(X[j,v,t]==0 for t in range(1,T+1) if v != venue[j])
+# Enforced in preprocessing: X only has variables for each job's own venue
 
 ### A3 & A4: Sessions for subjects in the same focus track do not clash
 cohort_str = re.compile("C")
@@ -177,8 +185,8 @@ for j in jobs:
 				# (1) Both j and k are in the same cohort (i.e. both CS01 or both CS02)
 				if class_num[j] == class_num[k] and bool(cohort_str.search(class_num[j])):
 					for t in range(1,T+1):
-						clash = sum(X[j,venue[j],s] for s in range(max(1,t+1-proc[j]),t+1))
-						clash += sum(X[k,venue[k],s] for s in range(max(1,t+1-proc[j]),t+1))
+						clash = gp.quicksum(X.get((j,venue[j],s), 0) for s in range(max(1,t+1-proc[j]),t+1))
+						clash += gp.quicksum(X.get((k,venue[k],s), 0) for s in range(max(1,t+1-proc[j]),t+1))
 						m.addConstr(clash <= 1, "no focus track course clashes (case 1)")
 				
 				# Implied: j and k are different cohorts or one is a lecture
@@ -189,8 +197,8 @@ for j in jobs:
 					# (2) j from single-cohort subject, k from multi-cohort subject of the same track
 					if num_cohort_subject_j == 1 and num_cohort_subject_k > 1:
 						for t in range(1,T+1):
-							clash = sum(X[j,venue[j],s] for s in range(max(1,t+1-proc[j]),t+1))
-							clash += sum(X[k,venue[k],s] for s in range(max(1,t+1-proc[j]),t+1))
+							clash = gp.quicksum(X.get((j,venue[j],s), 0) for s in range(max(1,t+1-proc[j]),t+1))
+							clash += gp.quicksum(X.get((k,venue[k],s), 0) for s in range(max(1,t+1-proc[j]),t+1))
 							m.addConstr(clash <= 1, "no focus track course clashes (case 2)")
 
 '''
@@ -223,10 +231,10 @@ for ft in ft_list:
 				# (1) If same cohort (e.g. both CS01) or either class is a lecture
 				if class_num[j] == class_num[k] or bool(lecture_str.search(class_num[j])) or bool(lecture_str.search(class_num[k])):
 					for t in range(1,T+1):
-						classcount_for_break = 0
+						classcount_for_break = gp.LinExpr()
 						for s in range(max(1,t-proc[j]),t+1):
-							classcount_for_break += X[j,venue[j],s]
-							classcount_for_break += X[k,venue[k],s]
+							classcount_for_break += X.get((j,venue[j],s), 0)
+							classcount_for_break += X.get((k,venue[k],s), 0)
 						m.addConstr((classcount_for_break <= 1 + Z[j,k,t]), "30min breaks (case 1)")
 				
 				# Implied: j and k are different cohorts
@@ -237,10 +245,10 @@ for ft in ft_list:
 
 					if num_cohort_subject_j == 1 and num_cohort_subject_k > 1:
 						for t in range(1,T+1):
-							classcount_for_break = 0
+							classcount_for_break = gp.LinExpr()
 							for s in range(max(1,t-proc[j]),t+1):
-								classcount_for_break += X[j,venue[j],s]
-								classcount_for_break += X[k,venue[k],s]
+								classcount_for_break += X.get((j,venue[j],s), 0)
+								classcount_for_break += X.get((k,venue[k],s), 0)
 							m.addConstr((classcount_for_break <= 1 + Z[j,k,t]), "30min breaks (case 2)")
 
 print("Constraints defined, starting optimization\n")
@@ -94,14 +94,10 @@ print("\nConverted csv data into multidict")
 
 ### Common Variables ##############################################################################
 
-print("Problem space: %d ESD jobs x %d venues x %d time indices = %d\n"
-% (len(jobs), len(set(venue.values())), T, len(jobs)*len(set(venue.values()))*T))
+time0 = time.time() # to check solution time
 
 print("Creating Gurobi model:")
 m = gp.Model("Adv Opti Task 3 by Kutosotase 2021")
-X = m.addVars([(j,v,t) for j in jobs for v in set(venue.values()) for t in range(1,T+1)], vtype=GRB.BINARY, name="X")
-
-time0 = time.time() # to check solution time
 
 # Variables to ensure classes of a subject are spread out across days
 EOD_splits = [(j,k,t) for j in jobs for k in jobs for t in range(4)]
@@ -147,6 +143,31 @@ if solve_variant == 3 or solve_variant == 4:
 	pass # no additional variables to define
 
 
+### Decision Variables (sparse) ###################################################################
+
+# A job may only start in its own venue (j=>v), at a time-index where it does not run into an EOD
+# or HASS block, and not where its venue is blocked by another pillar. X is only created for these,
+# so those constraints need no rows. (Built after the variants, which may add HASS block timings.)
+def feasible_starts(j):
+	blocked = set()
+	for t in EOD_timings + HASS_block_timings:
+		blocked.update(range(max(1,t-proc[j]+1), t+1))
+	for b in blocker:
+		if non_ESD_venue[b] == venue[j]:
+			blocked.update(range(block_start[b], block_end[b]+1))
+	return [t for t in range(1,T+1) if t not in blocked]
+
+X_keys = [(j,venue[j],t) for j in jobs for t in feasible_starts(j)]
+full_space = len(jobs)*len(set(venue.values()))*T
+
+print("Problem space: %d ESD jobs x %d venues x %d time indices = %d"
+% (len(jobs), len(set(venue.values())), T, full_space))
+print("Variables created for assigned venues and feasible start times only: %d (%d fewer, %.1f%% of the full space)\n"
+% (len(X_keys), full_space-len(X_keys), 100*len(X_keys)/full_space))
+
+X = m.addVars(X_keys, vtype=GRB.BINARY, name="X")
+
+
 ### Objective Function ############################################################################
 
 if solve_variant == 1: # Variant 1 - Minimise the lack of breaks
@@ -171,21 +192,21 @@ print("\nObjective function defined for Variant %g" % solve_variant)
 ### Common Constraints ############################################################################
 
 ### j=>v: Sessions must occupy the venue stipulated in the original timetable
-for j in jobs:
-	for v in set(venue.values()):
-		m.addConstrs(X[j,v,t]==0 for t in range(1,T+1) if v != venue[j])
+# Enforced when creating X: there are only variables for each job's own venue
 
 ### All classes must be assigned
 m.addConstrs((X.sum(j,"*","*")==1 for j in jobs), "all jobs assigned")
 
 ### At most 1 class at any venue at any time instant
 for v in set(venue.values()):
+	jobs_at_venue = [j for j in jobs if venue[j]==v]
 	for t in range(1,T+1):
-		jobs_in_venue = 0
-		for j in jobs:
+		jobs_in_venue = gp.LinExpr()
+		for j in jobs_at_venue:
 			for s in range(max(1,t+1-proc[j]), t+1):
-				jobs_in_venue += X[j,v,s]
-		m.addConstr(jobs_in_venue <= 1, "<=1 job per venue per time")
+				jobs_in_venue += X.get((j,v,s), 0)
+		if jobs_in_venue.size() > 0:
+			m.addConstr(jobs_in_venue <= 1, "<=1 job per venue per time")
 
 ### At most 1 class per instructor at any time instant
 for instr in set(instructor.values()):
@@ -199,16 +220,8 @@ for instr in set(instructor.values()):
 		m.addConstr(jobs_being_done <= 1, "<=1 job per prof per time")
 
 ### Venues are blocked by other pillars/HASS
-for v in set(venue.values()):
-	for b in blocker:
-		if v == non_ESD_venue[b]:
-			m.addConstrs((X.sum("*",v,t)==0 for t in range(block_start[b], block_end[b]+1)), "venues blocked by other pillars")
-
 ### Time slots are blocked by EOD and the blanket block period for HASS
-for t in EOD_timings:
-	m.addConstrs((X.sum(j,"*",s)==0 for j in jobs for s in range(max(1,t-proc[j]+1), t+1)), "time blocked by EOD")
-for t in HASS_block_timings:
-	m.addConstrs((X.sum(j,"*",s)==0 for j in jobs for s in range(max(1,t-proc[j]+1), t+1)), "time blocked for HASS")
+# Enforced when creating X: there are no variables for blocked start times
 
 ### Precedence constraints within the same subject
 ### & At most one session of each subject in a day
@@ -246,8 +259,8 @@ for j in jobs:
 				# (1) Both j and k are in the same cohort (i.e. both CS01 or both CS02)
 				if class_num[j] == class_num[k] and bool(cohort_str.search(class_num[j])):
 					for t in range(1,T+1):
-						clash = sum(X[j,venue[j],s] for s in range(max(1,t+1-proc[j]),t+1))
-						clash += sum(X[k,venue[k],s] for s in range(max(1,t+1-proc[j]),t+1))
+						clash = gp.quicksum(X.get((j,venue[j],s), 0) for s in range(max(1,t+1-proc[j]),t+1))
+						clash += gp.quicksum(X.get((k,venue[k],s), 0) for s in range(max(1,t+1-proc[j]),t+1))
 						m.addConstr(clash <= 1, "no focus track course clashes (case 1)")
 				
 				# Implied: j and k are different cohorts or one is a lecture
@@ -260,8 +273,8 @@ for j in jobs:
 						# Since j & k are asymmetric, they are only compared once (jk only, no kj)
 						proc_longer = max(proc[j], proc[k])
 						for t in range(1,T+1):
-							clash = sum(X[j,venue[j],s] for s in range(max(1,t+1-proc_longer),t+1))
-							clash += sum(X[k,venue[k],s] for s in range(max(1,t+1-proc_longer),t+1))
+							clash = gp.quicksum(X.get((j,venue[j],s), 0) for s in range(max(1,t+1-proc_longer),t+1))
+							clash += gp.quicksum(X.get((k,venue[k],s), 0) for s in range(max(1,t+1-proc_longer),t+1))
 							m.addConstr(clash <= 1, "no focus track course clashes (case 2)")
 
 
@@ -279,10 +292,10 @@ if solve_variant == 1 or solve_variant == 4:
 					# (1) If same cohort (e.g. both CS01) or either class is a lecture
 					if class_num[j] == class_num[k] or bool(lecture_str.search(class_num[j])) or bool(lecture_str.search(class_num[k])):
 						for t in range(1,T+1):
-							classcount_for_break = 0
+							classcount_for_break = gp.LinExpr()
 							for s in range(max(1,t-proc[j]),t+1):
-								classcount_for_break += X[j,venue[j],s]
-								classcount_for_break += X[k,venue[k],s]
+								classcount_for_break += X.get((j,venue[j],s), 0)
+								classcount_for_break += X.get((k,venue[k],s), 0)
 							m.addConstr((classcount_for_break <= 1 + Z[j,k,t]), "30min breaks (case 1)")
 					
 					# Implied: j and k are different cohorts
@@ -295,10 +308,10 @@ if solve_variant == 1 or solve_variant == 4:
 							# Since j & k are asymmetric, they are only compared once (jk only, no kj)
 							proc_longer = max(proc[j], proc[k])
 							for t in range(1,T+1):
-								classcount_for_break = 0
+								classcount_for_break = gp.LinExpr()
 								for s in range(max(1,t-proc_longer),t+1):
-									classcount_for_break += X[j,venue[j],s]
-									classcount_for_break += X[k,venue[k],s]
+									classcount_for_break += X.get((j,venue[j],s), 0)
+									classcount_for_break += X.get((k,venue[k],s), 0)
 								m.addConstr((classcount_for_break <= 1 + Z[j,k,t]), "30min breaks (case 2)")
 
 ### V2: Dmax implementation
@@ -314,7 +327,7 @@ if solve_variant == 2 or solve_variant == 4:
 				day_end = EOD_timings[d]
 				day_start = 1 if d==0 else EOD_timings[d-1]+1
 
-				ft_cohort_classes_in_day = 0
+				ft_cohort_classes_in_day = gp.LinExpr()
 				for j in jobs:
 
 					# If job j is part of the focus track
@@ -325,11 +338,11 @@ if solve_variant == 2 or solve_variant == 4:
 						# First constraint: check if day d is used by cohort l of focus track f
 						# If j is a lecture, always check
 						if bool(lecture_str.search(class_num[j])):
-							ft_cohort_classes_in_day += sum(X[j,venue[j],t] for t in range(day_start, day_end+1))
+							ft_cohort_classes_in_day += gp.quicksum(X.get((j,venue[j],t), 0) for t in range(day_start, day_end+1))
 							
 						# Elif j is the correct cohort number, then check
 						elif int(class_num[j][-2:]) == l:
-							ft_cohort_classes_in_day += sum(X[j,venue[j],t] for t in range(day_start, day_end+1))
+							ft_cohort_classes_in_day += gp.quicksum(X.get((j,venue[j],t), 0) for t in range(day_start, day_end+1))
 
 						# Second constraint: if j is from a single-cohort subject, count the day for all cohorts
 						num_cohort_subject_j = len(set(class_num[i] for i in jobs if subject[i]==subject[j] and not bool(lecture_str.search(class_num[j]))))
@@ -337,7 +350,7 @@ if solve_variant == 2 or solve_variant == 4:
 							
 							for l_iter in range(1,num_cohort_track+1):
 								# Use T as big M
-								m.addConstr((sum(X[j,venue[j],t] for t in range(day_start, day_end+1)) <= D[f, l_iter, d+1]*T), "all cohorts of FT use that day")
+								m.addConstr((gp.quicksum(X.get((j,venue[j],t), 0) for t in range(day_start, day_end+1)) <= D[f, l_iter, d+1]*T), "all cohorts of FT use that day")
 					
 				# First constraint implementation (using T as big M)
 				m.addConstr((ft_cohort_classes_in_day <= D[f,l,d+1]*T), "classes of a focus track in a day")
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for T3 2D - Primer Design.py
+
+1. Build seeded synthetic templates of each size (2 kb up to 10 Mb)
+2. Time set_dna_sequence and every cost criterion (evaluations per second)
+3. Time each search mode, and annealing to a target cost, on an AT-rich
+   template where a zero-cost pair is rare, with stop_at_zero_cost off so
+   every mode runs its full schedule
+4. Write everything to a json file; compare with an earlier one to catch
+   regressions
+
+Usage: python "T3 2D - Primer Design Benchmark.py" [--sizes 2000 100000 ...]
+           [--search-cg-fraction 0.25] [--output results.json]
+           [--baseline old_results.json]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+'''the primer design script has spaces in its name, so load it by path'''
+'''it is registered in sys.modules so that pool workers can unpickle its functions'''
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location('primer_design', os.path.join(HERE, 'T3 2D - Primer Design.py'))
+primer_design = importlib.util.module_from_spec(spec)
+sys.modules['primer_design'] = primer_design
+spec.loader.exec_module(primer_design)
+PrimerDesign = primer_design.PrimerDesign
+
+DEFAULT_SIZES = [2000, 100000, 1000000, 10000000]
+
+'''C+G fraction of the templates the search modes are timed on; on uniform'''
+'''templates every mode finds a zero-cost pair almost at once'''
+SEARCH_CG_FRACTION = 0.25
+
+'''=================================================== Synthetic templates '''
+def synthetic_template(n_bases, seed=0, cg_fraction=0.5):
+    rng = np.random.default_rng(seed)
+    if cg_fraction == 0.5:
+        codes = rng.integers(0, 4, n_bases)
+    else:
+        at, cg = (1 - cg_fraction) / 2, cg_fraction / 2
+        codes = rng.choice(4, n_bases, p=[at, cg, cg, at])
+    return primer_design.BASE_LETTERS[codes].tobytes().decode('ascii')
+
+'''random primer windows inside the usual fp/rp regions, fixed by seed'''
+def sample_windows(my_primer, n, seed=0):
+    rng = random.Random(seed)
+    windows = []
+    for i in range(n):
+        sqtype = 'forward' if i % 2 == 0 else 'reverse'
+        windows.append(my_primer.func_select_random_window(sqtype, rng.randint(my_primer.min_length,
+                                                                               my_primer.max_length)))
+    return windows
+
+'''================================================================ Timing '''
+'''calls func(*args) for each args in args_list, repeating until min_time has'''
+'''passed; returns evaluations per second'''
+def evaluations_per_second(func, args_list, min_time=0.2):
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.
+    while elapsed < min_time:
+        for args in args_list:
+            func(*args)
+        calls += len(args_list)
+        elapsed = time.perf_counter() - start
+
+    return calls / elapsed
+
+def bench_criteria(my_primer, windows, min_time):
+    primers = [(my_primer.func_window(*w),) for w in windows]
+    pairs = list(zip(primers[0::2], primers[1::2]))
+    pairs = [(fp[0], rp[0]) for fp, rp in pairs]
+    window_pairs = [(*fp, *rp) for fp, rp in zip(windows[0::2], windows[1::2])]
+
+    def uncached_primer_cost(start, length):
+        my_primer.clear_cost_cache()
+        return my_primer.cost_primer_window(start, length)
+
+    results = {}
+    for name in ['cost_length', 'cost_cgcontent', 'cost_temperature', 'cost_specificity',
+                 'cost_runs', 'cost_repeats', 'cost_self_dimer', 'cost_hairpin']:
+        results[name] = evaluations_per_second(getattr(my_primer, name), primers, min_time)
+    for name in ['cost_cgcontent_window', 'cost_temperature_window']:
+        results[name] = evaluations_per_second(getattr(my_primer, name), windows, min_time)
+    results['cost_cross_dimer'] = evaluations_per_second(my_primer.cost_cross_dimer, pairs, min_time)
+    results['cost_temperature_difference'] = evaluations_per_second(
+        my_primer.cost_temperature_difference, pairs, min_time)
+    results['calculate_values'] = evaluations_per_second(my_primer.calculate_values, pairs, min_time)
+    results['cost_objective_function'] = evaluations_per_second(my_primer.cost_objective_function, pairs, min_time)
+    results['cost_objective_function_window'] = evaluations_per_second(
+        my_primer.cost_objective_function_window, window_pairs, min_time)
+    results['cost_primer_window (uncached)'] = evaluations_per_second(uncached_primer_cost, windows, min_time)
+
+    return results
+
+'''notes the time and iteration at which the best cost first reaches target_cost'''
+class TargetTelemetry(primer_design.AnnealingTelemetry):
+
+    def __init__(self, target_cost):
+        primer_design.AnnealingTelemetry.__init__(self, progress='silent')
+        self.target_cost = target_cost
+
+    def start(self, my_primer, temperature, cost):
+        primer_design.AnnealingTelemetry.start(self, my_primer, temperature, cost)
+        self.time_to_target = 0. if cost <= self.target_cost else None
+        self.iterations_to_target = 0 if cost <= self.target_cost else None
+
+    def update(self, i, temperature, state, accepted):
+        primer_design.AnnealingTelemetry.update(self, i, temperature, state, accepted)
+        if self.time_to_target is None and self.best_cost <= self.target_cost:
+            self.time_to_target = time.time() - self.start_time
+            self.iterations_to_target = i
+
+'''stop_at_zero_cost is turned off, so that the times measure the search itself'''
+def bench_search(my_primer, seeds, target_cost, processes):
+    results = {}
+    my_primer.stop_at_zero_cost = False
+
+    '''annealing, one chain at a time'''
+    costs = []
+    times = []
+    to_target = []
+    for seed in seeds:
+        telemetry = TargetTelemetry(target_cost)
+        start = time.perf_counter()
+        fp, rp, cost, iterations = my_primer.func_simulated_annealing(seed=seed, verbose=False,
+                                                                      telemetry=telemetry)
+        times.append(time.perf_counter() - start)
+        costs.append(cost)
+        to_target.append(telemetry.time_to_target)
+    reached = [t for t in to_target if t is not None]
+    results['annealing'] = {'mean_cost': float(np.mean(costs)), 'mean_time': float(np.mean(times)),
+                            'target_cost': target_cost, 'reached_target': len(reached) / len(seeds),
+                            'mean_time_to_target': float(np.mean(reached)) if reached else None}
+
+    start = time.perf_counter()
+    (fp, rp, cost), chain_stats = my_primer.func_parallel_annealing(processes=processes, base_seed=seeds[0],
+                                                                    verbose=False)
+    results['parallel_annealing'] = {'cost': cost, 'time': time.perf_counter() - start}
+
+    start = time.perf_counter()
+    (fp, rp, cost), stats = my_primer.func_parallel_tempering(processes=processes, seed=seeds[0], verbose=False)
+    results['parallel_tempering'] = {'cost': cost, 'time': time.perf_counter() - start,
+                                     'evaluations': stats['evaluations']}
+
+    start = time.perf_counter()
+    cost, fp, rp = my_primer.func_exhaustive_search(top_k=10, verbose=False)[0]
+    results['exhaustive'] = {'cost': cost, 'time': time.perf_counter() - start}
+
+    return results
+
+'''================================================================= Driver '''
+def new_primer_design(template):
+    my_primer = PrimerDesign("benchmark")
+    '''the default regions assume at least 2091 bases'''
+    my_primer.rp_end = min(my_primer.rp_end, len(template)-1)
+    my_primer.set_dna_sequence(template)
+
+    return my_primer
+
+def run_benchmarks(sizes, n_windows=200, min_time=0.2, seeds=(0, 1, 2), target_cost=1., processes=None,
+                   search_sizes=None, search_cg_fraction=SEARCH_CG_FRACTION, verbose=True):
+    if search_sizes is None:
+        search_sizes = sizes[:1]
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__,
+               'machine': platform.machine(), 'cpu_count': os.cpu_count(),
+               'search_cg_fraction': search_cg_fraction, 'sizes': {}}
+
+    for n_bases in sizes:
+        template = synthetic_template(n_bases, seed=n_bases)
+        start = time.perf_counter()
+        my_primer = new_primer_design(template)
+        size_results = {'set_dna_sequence': time.perf_counter() - start}
+
+        windows = sample_windows(my_primer, n_windows)
+        size_results['evaluations_per_second'] = bench_criteria(my_primer, windows, min_time)
+        if n_bases in search_sizes:
+            search_template = synthetic_template(n_bases, seed=n_bases, cg_fraction=search_cg_fraction)
+            size_results['search'] = bench_search(new_primer_design(search_template), list(seeds),
+                                                  target_cost, processes)
+        results['sizes'][str(n_bases)] = size_results
+
+        if verbose:
+            print_size_results(n_bases, size_results)
+
+    return results
+
+def print_size_results(n_bases, size_results):
+    print("\n=== Template of {} bases ===".format(n_bases))
+    print("set_dna_sequence: {:.3f}s".format(size_results['set_dna_sequence']))
+    print("{:<34}{:>14}".format("Criterion", "Evals/s"))
+    for name, rate in size_results['evaluations_per_second'].items():
+        print("{:<34}{:>14,.0f}".format(name, rate))
+    if 'search' in size_results:
+        print("{:<34}{:>10}{:>10}".format("Search mode", "Cost", "Time (s)"))
+        for mode, stats in size_results['search'].items():
+            cost = stats.get('cost', stats.get('mean_cost'))
+            seconds = stats.get('time', stats.get('mean_time'))
+            print("{:<34}{:>10.2f}{:>10.3f}".format(mode, cost, seconds))
+
+'''lists every evaluation rate that dropped by more than tolerance since baseline'''
+def compare_with_baseline(results, baseline, tolerance=0.2):
+    regressions = []
+    for size, size_results in results['sizes'].items():
+        old = baseline.get('sizes', {}).get(size)
+        if old is None:
+            continue
+        for name, rate in size_results['evaluations_per_second'].items():
+            old_rate = old['evaluations_per_second'].get(name)
+            if old_rate and rate < (1 - tolerance) * old_rate:
+                regressions.append((size, name, old_rate, rate))
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark PrimerDesign cost evaluation and search.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--search-sizes', type=int, nargs='+', default=None,
+                        help='template sizes to run the search modes on (default: the smallest)')
+    parser.add_argument('--windows', type=int, default=200)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--target-cost', type=float, default=1.)
+    parser.add_argument('--search-cg-fraction', type=float, default=SEARCH_CG_FRACTION,
+                        help='C+G fraction of the templates the search modes run on')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--output', default='primer_design_benchmark.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, n_windows=args.windows, min_time=args.min_time,
+                             target_cost=args.target_cost, processes=args.processes,
+                             search_sizes=args.search_sizes, search_cg_fraction=args.search_cg_fraction)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nResults written to {}'.format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print('\n=== Regressions (more than {:.0%} slower) ==='.format(args.tolerance))
+            for size, name, old_rate, rate in regressions:
+                print('{:>10} bases  {:<34}{:>14,.0f} -> {:,.0f}'.format(size, name, old_rate, rate))
+            raise SystemExit(1)
+        print('No regressions against {}'.format(args.baseline))
@@ -6,9 +6,511 @@ Created on Sun Apr 08 10:37:18 2018
 """
 import random
 import math
+import time
+import csv
+import json
+import re
+import os
+import operator
+from collections import OrderedDict, deque
+from multiprocessing import Pool, cpu_count
+import numpy as np
+
+BASES = frozenset('atcg')
+
+'''complement of each base, used to read the other strand'''
+COMPLEMENT = str.maketrans('atcg', 'tagc')
+
+def reverse_complement(sq):
+    return sq.translate(COMPLEMENT)[::-1]
+
+'''2-bit code of each base (a, c, g, t = 0, 1, 2, 3); the complement of a code is code ^ 3'''
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b'acgt'):
+    BASE_CODES[base] = code
+
+BASE_LETTERS = np.frombuffer(b'acgt', dtype=np.uint8)
+NOT_A_BASE = re.compile('[^atcg]')
+
+def encode_sequence(sq):
+    return BASE_CODES[np.frombuffer(sq.encode('ascii'), dtype=np.uint8)]
+
+'''a DNA sequence (a, t, c, g only) stored at 2 bits per base, 4 bases per byte'''
+'''slicing returns str, like slicing the template str would; a sequence saved'''
+'''to disk can be memory-mapped, so processes reading it share one copy, and so'''
+'''can the prefix counts and k-mer index saved with it (see load_table)'''
+class PackedSequence(object):
+    
+    magic = b'PDNA'
+    header_size = 12
+    
+    def __init__(self, packed, length, path=None):
+        self.packed = packed
+        self.length = length
+        self.path = path
+    
+    @classmethod
+    def from_string(cls, sq):
+        '''characters other than a, t, c, g are dropped'''
+        codes = encode_sequence(NOT_A_BASE.sub('', sq))
+        length = len(codes)
+        
+        '''pad to whole bytes, then put the first of every 4 bases in the top bits'''
+        codes = np.concatenate([codes, np.zeros(-length % 4, dtype=np.uint8)]).reshape(-1, 4)
+        packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+        
+        return cls(packed, length)
+    
+    '''file layout: magic, no. of bases as a little-endian uint64, packed bytes'''
+    '''the prefix counts, nearest-neighbour prefix sums and the index of index_kmer-mers (use the index_kmer of'''
+    '''the PrimerDesign that will read it) are saved beside it as .npy files'''
+    def save(self, path, index_kmer=12):
+        with open(path, 'wb') as f:
+            f.write(self.magic)
+            f.write(int(self.length).to_bytes(8, 'little'))
+            f.write(np.asarray(self.packed, dtype=np.uint8).tobytes())
+        
+        tables = build_prefix_counts(self) + build_nn_prefix(self) + build_kmer_index(self, index_kmer)
+        for name, table in zip(PREFIX_TABLES + NN_TABLES + kmer_tables(index_kmer), tables):
+            np.save(table_path(path, name), table)
+    
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(path, 'rb') as f:
+            header = f.read(cls.header_size)
+            if header[:4] != cls.magic:
+                raise ValueError('{} is not a packed DNA sequence file'.format(path))
+            length = int.from_bytes(header[4:], 'little')
+            if not mmap:
+                return cls(np.frombuffer(f.read(), dtype=np.uint8), length, path)
+        
+        if length == 0:
+            return cls(np.zeros(0, dtype=np.uint8), 0, path)
+        
+        return cls(np.memmap(path, dtype=np.uint8, mode='r', offset=cls.header_size), length, path)
+    
+    '''a table saved beside the sequence file, memory-mapped if the sequence is;'''
+    '''None if there is no such table'''
+    def load_table(self, name):
+        if self.path is None or not os.path.exists(table_path(self.path, name)):
+            return None
+        
+        return np.load(table_path(self.path, name), mmap_mode='r' if isinstance(self.packed, np.memmap) else None)
+    
+    '''memory-mapped sequences are re-opened by path instead of being copied'''
+    def __reduce__(self):
+        if self.path is not None and isinstance(self.packed, np.memmap):
+            return (PackedSequence.load, (self.path,))
+        
+        return (PackedSequence, (np.asarray(self.packed), self.length))
+    
+    def __len__(self):
+        return self.length
+    
+    '''2-bit codes of the bases in [start, stop)'''
+    def codes(self, start, stop):
+        start = max(start, 0)
+        stop = min(stop, self.length)
+        if stop <= start:
+            return np.zeros(0, dtype=np.uint8)
+        
+        first = start >> 2
+        block = np.asarray(self.packed[first : (stop+3) >> 2])
+        codes = np.stack([block >> 6, (block >> 4) & 3, (block >> 2) & 3, block & 3], axis=1).ravel()
+        
+        return codes[start - 4*first : stop - 4*first]
+    
+    '''2-bit codes at an array of positions'''
+    def codes_at(self, positions):
+        block = np.asarray(self.packed)[positions >> 2]
+        
+        return (block >> (6 - 2 * (positions & 3)).astype(np.uint8)) & 3
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return str(self)[key]
+        else:
+            if key < 0:
+                key += self.length
+            if not 0 <= key < self.length:
+                raise IndexError('PackedSequence index out of range')
+            start, stop = key, key+1
+        
+        return BASE_LETTERS[self.codes(start, stop)].tobytes().decode('ascii')
+    
+    def __str__(self):
+        return self[:]
+    
+    def startswith(self, prefix, start=0):
+        return self[start : start+len(prefix)] == prefix
+    
+    '''like str.find, decoding chunk_size bases at a time'''
+    def find(self, sub, start=0, chunk_size=1 << 20):
+        start = max(start, 0)
+        while start + len(sub) <= self.length:
+            text = self[start : start + chunk_size + len(sub) - 1]
+            i = text.find(sub)
+            if i != -1:
+                return start + i
+            start += chunk_size
+        
+        return -1
+
+'''tables saved beside a PackedSequence file, as path.<name>.npy'''
+PREFIX_TABLES = ('cg_prefix', 'at_prefix')
+NN_TABLES = ('nn_enthalpy_prefix', 'nn_entropy_prefix')
+
+def kmer_tables(k):
+    return ('kmer{}_codes'.format(k), 'kmer{}_positions'.format(k))
+
+def table_path(path, name):
+    return '{}.{}.npy'.format(path, name)
+
+'''2-bit codes at an array of positions of an encoded sequence (array or packed)'''
+def codes_at(codes, positions):
+    if isinstance(codes, PackedSequence):
+        return codes.codes_at(positions)
+    
+    return codes[positions]
+
+'''2-bit codes of the bases in [start, stop) of an encoded sequence (array or packed)'''
+def codes_between(codes, start, stop):
+    if isinstance(codes, PackedSequence):
+        return codes.codes(start, stop)
+    
+    return codes[start:stop]
+
+'''cumulative base counts of an encoded sequence (array or packed), so that any'''
+'''window can be scored in O(1): cg_prefix[i] is the number of Cs and Gs in the'''
+'''first i bases, at_prefix[i] the number of As and Ts'''
+def build_prefix_counts(codes, chunk_size=1 << 20):
+    dtype = np.int32 if len(codes) < 2**31 else np.int64
+    cg_prefix = np.zeros(len(codes)+1, dtype=dtype)
+    
+    for start in range(0, len(codes), chunk_size):
+        chunk = codes_between(codes, start, start+chunk_size)
+        counts = cg_prefix[start+1 : start+1+len(chunk)]
+        np.cumsum((chunk == 1) | (chunk == 2), dtype=dtype, out=counts)
+        counts += cg_prefix[start]
+    
+    return cg_prefix, np.arange(len(codes)+1, dtype=dtype) - cg_prefix
+
+'''a k-mer of up to 32 bases as one int of 2-bit codes, first base in the highest'''
+'''bits, so that k-mers sort in the same order as their strings'''
+def kmer_dtype(k):
+    return np.uint32 if k <= 16 else np.uint64
+
+def encode_kmer(sq):
+    value = 0
+    for base in sq:
+        value = (value << 2) | BASE_INDEX[base]
+    
+    return value
+
+'''sorted k-mer index of an encoded sequence (array or packed): the code of every'''
+'''k-mer in ascending order, and the position each one starts at; equal k-mers'''
+'''are in order of position. Both are flat arrays, about 8 bytes per base'''
+'''k-mers holding a character that is not a base (code > 3) are left out'''
+def build_kmer_index(codes, k, chunk_size=1 << 20):
+    if not 1 <= k <= 32:
+        raise ValueError('index k-mers must be 1 to 32 bases long, not {}'.format(k))
+    
+    dtype = kmer_dtype(k)
+    n_kmers = max(len(codes) - k + 1, 0)
+    kmers = np.empty(n_kmers, dtype=dtype)
+    usable = None
+    
+    '''shift in one base of every k-mer of the chunk at a time'''
+    for start in range(0, n_kmers, chunk_size):
+        chunk = codes_between(codes, start, start+chunk_size+k-1)
+        n = len(chunk) - k + 1
+        not_bases = np.concatenate([[0], np.cumsum(chunk > 3)])
+        if not_bases[-1]:
+            if usable is None:
+                usable = np.ones(n_kmers, dtype=bool)
+            usable[start : start+n] = not_bases[k : k+n] == not_bases[:n]
+        
+        chunk = (chunk & 3).astype(dtype)
+        values = np.zeros(n, dtype=dtype)
+        for j in range(k):
+            values = (values << dtype(2)) | chunk[j : j+n]
+        kmers[start : start+n] = values
+    
+    order = np.argsort(kmers, kind='stable')
+    if usable is not None:
+        order = order[usable[order]]
+    positions = order.astype(np.int32 if n_kmers < 2**31 else np.int64)
+    
+    return kmers[order], positions
+
+'''the bases of many windows of an encoded sequence as one row per window'''
+'''valid marks the columns that lie inside each window'''
+def window_matrix(codes, starts, lengths):
+    offsets = np.arange(lengths.max())
+    positions = np.minimum(starts[:, None] + offsets, len(codes)-1)
+    
+    return codes_at(codes, positions), offsets < lengths[:, None]
+
+'''a primer as one int of 2-bit codes (first base in the lowest bits), plus a'''
+'''mask with the low bit of each field set where the base is a, c, g or t'''
+BASE_INDEX = {'a': 0, 'c': 1, 'g': 2, 't': 3}
+
+def pack_primer(sq):
+    packed = 0
+    valid = 0
+    for i, base in enumerate(sq):
+        code = BASE_INDEX.get(base)
+        if code is not None:
+            packed |= code << (2*i)
+            valid |= 1 << (2*i)
+    
+    return packed, valid
+
+'''longest stretch of consecutive Watson-Crick pairs between primer x and primer y,'''
+'''both 5'->3', annealed antiparallel at any offset; x is pack_primer(x) and'''
+'''y_reversed is pack_primer(y[::-1]); each offset compares every position at'''
+'''once: a field of x ^ y that is 11 is a complementary pair (code ^ 3)'''
+'''with min_loop set, x and y are one primer folding back on itself (hairpin),'''
+'''so only pairs at least min_loop+1 bases apart count'''
+'''runs of at_least bases or fewer are not looked for: offsets are tried from the'''
+'''longest overlap down, and the search stops once no overlap left is longer than'''
+'''the longest run found (or at_least); at_least is returned if nothing is longer'''
+def longest_complementary_run(x, y_reversed, x_length, y_length, min_loop=None, at_least=0):
+    x_packed, x_valid = x
+    y_packed, y_valid = y_reversed
+    longest = at_least
+    
+    '''at offset k, x[i] meets y[::-1][i-k]'''
+    for overlap, k in offsets_by_overlap(x_length, y_length):
+        if overlap <= longest:
+            break
+        
+        if k >= 0:
+            a, a_valid = x_packed, x_valid
+            b, b_valid = y_packed << (2*k), y_valid << (2*k)
+        else:
+            a, a_valid = x_packed << (-2*k), x_valid << (-2*k)
+            b, b_valid = y_packed, y_valid
+        
+        z = a ^ b
+        pairs = z & (z >> 1) & a_valid & b_valid
+        
+        '''x[i] pairs with x[j], j = length-1-i+k; keep j - i > min_loop'''
+        if min_loop is not None and pairs:
+            i_max = (x_length - 2 + k - min_loop) // 2
+            if i_max < 0:
+                continue
+            pairs &= (1 << (2 * (i_max + 1 + max(-k, 0)))) - 1
+        
+        '''length of the longest run of set fields'''
+        run = 0
+        while pairs:
+            pairs &= pairs >> 2
+            run += 1
+        if run > longest:
+            longest = run
+    
+    return longest
+
+'''the offsets of longest_complementary_run with the no. of bases overlapping at'''
+'''each, longest overlap first'''
+OFFSET_ORDERS = {}
+
+def offsets_by_overlap(x_length, y_length):
+    order = OFFSET_ORDERS.get((x_length, y_length))
+    if order is None:
+        order = sorted(((min(x_length, k + y_length) - max(k, 0), k)
+                        for k in range(-(y_length-1), x_length)), reverse=True)
+        OFFSET_ORDERS[(x_length, y_length)] = order
+    
+    return order
+
+'''SantaLucia (1998) unified nearest-neighbour parameters for each dinucleotide'''
+'''(5'->3' on the primer): (enthalpy in kcal/mol, entropy in cal/K/mol)'''
+NN_PARAMETERS = {'aa': (-7.9, -22.2), 'tt': (-7.9, -22.2),
+                 'at': (-7.2, -20.4), 'ta': (-7.2, -21.3),
+                 'ca': (-8.5, -22.7), 'tg': (-8.5, -22.7),
+                 'gt': (-8.4, -22.4), 'ac': (-8.4, -22.4),
+                 'ct': (-7.8, -21.0), 'ag': (-7.8, -21.0),
+                 'ga': (-8.2, -22.2), 'tc': (-8.2, -22.2),
+                 'cg': (-10.6, -27.2), 'gc': (-9.8, -24.4),
+                 'gg': (-8.0, -19.9), 'cc': (-8.0, -19.9)}
+
+'''initiation with a terminal G.C or A.T pair, added once for each end'''
+NN_INITIATION = {'g': (0.1, -2.8), 'c': (0.1, -2.8), 'a': (2.3, 4.1), 't': (2.3, 4.1)}
+
+'''the same, as arrays indexed by 4 * code + next code, and by code'''
+NN_ENTHALPY = np.array([NN_PARAMETERS[a+b][0] for a in 'acgt' for b in 'acgt'])
+NN_ENTROPY = np.array([NN_PARAMETERS[a+b][1] for a in 'acgt' for b in 'acgt'])
+NN_INIT_ENTHALPY = np.array([NN_INITIATION[a][0] for a in 'acgt'])
+NN_INIT_ENTROPY = np.array([NN_INITIATION[a][1] for a in 'acgt'])
+
+'''cumulative nearest-neighbour stacking sums of an encoded sequence (array or'''
+'''packed): enthalpy_prefix[i] sums the stacks between bases j and j+1 for all'''
+'''j < i; float64, so the pair takes 16 bytes per base'''
+def build_nn_prefix(codes, chunk_size=1 << 20):
+    enthalpy_prefix = np.zeros(max(len(codes), 1))
+    entropy_prefix = np.zeros(max(len(codes), 1))
+    
+    for start in range(0, len(codes)-1, chunk_size):
+        chunk = (codes_between(codes, start, start+chunk_size+1) & 3).astype(np.intp)
+        stacks = 4 * chunk[:-1] + chunk[1:]
+        stop = start + 1 + len(stacks)
+        for prefix, table in ((enthalpy_prefix, NN_ENTHALPY), (entropy_prefix, NN_ENTROPY)):
+            np.cumsum(table[stacks], out=prefix[start+1 : stop])
+            prefix[start+1 : stop] += prefix[start]
+    
+    return enthalpy_prefix, entropy_prefix
+
+'''Tm in degrees C from summed enthalpy (kcal/mol) and entropy (cal/K/mol) of a'''
+'''duplex of n_bases, with the salt correction to entropy of SantaLucia (1998)'''
+'''na_conc and primer_conc are molar; works on scalars and arrays alike'''
+def nn_melting_temperature(enthalpy, entropy, n_bases, na_conc, primer_conc):
+    entropy = entropy + 0.368 * (n_bases - 1) * math.log(na_conc)
+    
+    return 1000 * enthalpy / (entropy + 1.987 * math.log(primer_conc / 4)) - 273.15
+
+'''array version of PrimerDesign.cost_outside_limits'''
+def cost_outside_limits_array(values, min_value, max_value, penalty):
+    return np.where(values > max_value, (values - max_value) * penalty,
+                    np.where(values < min_value, (min_value - values) * penalty, 0))
+
+'''cooling schedules for func_simulated_annealing'''
+'''start() is called once per run; next_temperature() once per iteration, with'''
+'''a moving average of the fraction of proposed moves that were accepted'''
+class GeometricCooling(object):
+    '''T <- drop_fraction * T, the original schedule'''
+    
+    def __init__(self, drop_fraction=0.999):
+        self.drop_fraction = drop_fraction
+    
+    def start(self, temperature):
+        pass
+    
+    def next_temperature(self, temperature, acceptance_rate):
+        return temperature * self.drop_fraction
+
+class LundyMeesCooling(object):
+    '''T <- T / (1 + beta * T): fast while hot, slow near the stopping temperature'''
+    
+    def __init__(self, beta=0.01):
+        self.beta = beta
+    
+    def start(self, temperature):
+        pass
+    
+    def next_temperature(self, temperature, acceptance_rate):
+        return temperature / (1 + self.beta * temperature)
+
+class AdaptiveCooling(object):
+    '''cools by fast_drop while more moves are accepted than target_acceptance'''
+    '''and by slow_drop otherwise; when acceptance falls below reheat_below,'''
+    '''the temperature is multiplied by reheat_factor, at most max_reheats times'''
+    '''and at least reheat_cooldown iterations apart, so that the moving average'''
+    '''of acceptance can recover before the next reheat is considered'''
+    
+    def __init__(self, target_acceptance=0.1, fast_drop=0.997, slow_drop=0.9993,
+                 reheat_below=0.002, reheat_factor=10, max_reheats=3, reheat_cooldown=500):
+        self.target_acceptance = target_acceptance
+        self.fast_drop = fast_drop
+        self.slow_drop = slow_drop
+        self.reheat_below = reheat_below
+        self.reheat_factor = reheat_factor
+        self.max_reheats = max_reheats
+        self.reheat_cooldown = reheat_cooldown
+    
+    def start(self, temperature):
+        self.reheats = 0
+        self.since_reheat = self.reheat_cooldown
+    
+    def next_temperature(self, temperature, acceptance_rate):
+        self.since_reheat += 1
+        if (acceptance_rate < self.reheat_below and self.reheats < self.max_reheats
+                and self.since_reheat >= self.reheat_cooldown):
+            self.reheats += 1
+            self.since_reheat = 0
+            return temperature * self.reheat_factor
+        
+        if acceptance_rate > self.target_acceptance:
+            return temperature * self.fast_drop
+        
+        return temperature * self.slow_drop
+
+'''progress reporting and tracing for func_simulated_annealing'''
+'''progress is 'silent', 'throttled' (a line at most every interval seconds)'''
+'''or 'every' (a line per iteration); with trace_path set, the iteration,'''
+'''temperature, current and best cost and the acceptance rate over the last'''
+'''trace_every iterations are sampled and saved as a compressed .npz file'''
+class AnnealingTelemetry(object):
+    
+    def __init__(self, progress='throttled', interval=1.0, trace_path=None, trace_every=10):
+        self.progress = progress
+        self.interval = interval
+        self.trace_path = trace_path
+        self.trace_every = trace_every
+    
+    def start(self, primer_design, temperature, cost):
+        self.primer_design = primer_design
+        self.start_time = time.time()
+        self.last_print = self.start_time
+        self.best_cost = cost
+        self.accepted = 0
+        self.trace = []
+        self.record(0, temperature, cost, 0.)
+    
+    def record(self, i, temperature, cost, acceptance_rate):
+        if self.trace_path is not None:
+            self.trace.append((i, temperature, cost, self.best_cost, acceptance_rate))
+    
+    def update(self, i, temperature, state, accepted):
+        cost = state[2]
+        if cost < self.best_cost:
+            self.best_cost = cost
+        self.accepted += accepted
+        
+        if i % self.trace_every == 0:
+            self.record(i, temperature, cost, self.accepted / self.trace_every)
+            self.accepted = 0
+        
+        if self.progress == 'every':
+            print("Running iteration {:>4}: fp ({:<22}), rp ({:<22}), cost {:.2f}"
+                      .format(i, self.primer_design.func_window(*state[0]),
+                              self.primer_design.func_window(*state[1]), cost))
+        elif self.progress == 'throttled':
+            now = time.time()
+            if now - self.last_print >= self.interval:
+                self.last_print = now
+                print("Iteration {:>6}: temperature {:>9.4f}, cost {:>8.2f}, best {:>8.2f}"
+                          .format(i, temperature, cost, self.best_cost))
+    
+    def finish(self):
+        if self.trace_path is None:
+            return
+        
+        trace = np.array(self.trace, dtype=float).reshape(-1, 5)
+        np.savez_compressed(self.trace_path,
+                            iteration=trace[:, 0].astype(np.int32),
+                            temperature=trace[:, 1].astype(np.float32),
+                            current_cost=trace[:, 2].astype(np.float32),
+                            best_cost=trace[:, 3].astype(np.float32),
+                            acceptance_rate=trace[:, 4].astype(np.float32))
 
 class PrimerDesign(object):
     
+    '''attributes that change the cost of a primer; each is a property (see'''
+    '''cost_parameter below) that empties the cost caches when it is set'''
+    cost_parameters = ('max_length', 'min_length', 'penalty_length',
+                       'max_cg', 'min_cg', 'penalty_cg',
+                       'max_temp', 'min_temp', 'penalty_temp',
+                       'tm_model', 'na_conc', 'primer_conc',
+                       'run_threshold', 'penalty_runs',
+                       'repeat_threshold', 'penalty_repeats',
+                       'penalty_specificity', 'specificity_both_strands',
+                       'dimer_threshold', 'penalty_dimer',
+                       'hairpin_threshold', 'min_hairpin_loop', 'penalty_hairpin')
+    
     def __init__ (self, name):
         
         '''parameters for the length criterion'''
@@ -31,6 +533,12 @@ class PrimerDesign(object):
         self.min_temp = 55
         self.penalty_temp = 10
         
+        ''''wallace' (4 per C/G, 2 per A/T) or 'nearest_neighbour' (SantaLucia 1998)'''
+        '''the nearest-neighbour model uses the Na+ and primer concentrations (molar)'''
+        self.tm_model = 'wallace'
+        self.na_conc = 0.05
+        self.primer_conc = 50e-9
+        
         '''parameters for the run criterion'''
         self.run_threshold = 4
         self.penalty_runs = 10
@@ -39,8 +547,24 @@ class PrimerDesign(object):
         self.repeat_threshold = 0
         self.penalty_repeats = 10
         
+        '''parameters for the dimer and hairpin criteria'''
+        '''longest complementary stretch allowed between primers, and in a hairpin stem'''
+        self.dimer_threshold = 4
+        self.penalty_dimer = 10
+        self.hairpin_threshold = 3
+        self.min_hairpin_loop = 3
+        self.penalty_hairpin = 10
+        
         '''parameters for the specificity criterion'''
         self.penalty_specificity = 10 
+        self.specificity_both_strands = True
+        self.index_kmer = 12
+        
+        '''parameters for multiplex design: every primer of a panel lies within'''
+        '''multiplex_max_tdiff of every other, and no two pairs may form a dimer'''
+        '''longer than dimer_threshold'''
+        self.multiplex_max_tdiff = 5
+        self.multiplex_candidates = 20
         
         '''locations where the forward primer should be chosen from'''
         self.fp_start = 0
@@ -54,18 +578,149 @@ class PrimerDesign(object):
         self.initial_temperature = 200
         self.stopping_temperature = 0.01
         self.drop_fraction = 0.999
+        self.cooling_schedule = None        # None: GeometricCooling(drop_fraction)
+        
+        '''stopping criteria besides the stopping temperature (None to disable)'''
+        self.stop_at_zero_cost = True
+        self.stall_iterations = None        # iterations without a new best cost
+        self.time_budget = None             # seconds
+        
+        '''per-primer cost cache, keyed by (start, length), least recently used evicted'''
+        self.cost_cache_size = 4096
+        self.cost_cache = OrderedDict()
+        self.cost_cache_hits = 0
+        self.cost_cache_misses = 0
+        
+        '''cross-dimer cost cache, keyed by the (fp, rp) pair of windows'''
+        self.cross_dimer_cache_size = 16384
+        self.cross_dimer_cache = OrderedDict()
+    
+    '''template tables memory-mapped from disk are not pickled; each process that'''
+    '''unpickles this object (e.g. a pool worker) maps the same files instead'''
+    shared_tables = ('cg_prefix', 'at_prefix', 'nn_enthalpy_prefix', 'nn_entropy_prefix',
+                     'kmer_codes', 'kmer_positions')
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.shared_tables:
+            if isinstance(state.get(name), np.memmap):
+                state[name] = None
+        
+        return state
     
-    def set_dna_sequence(self, input_dna):
-        bases = 'atcg'
-        result = ''
+    def __setstate__(self, state):
+        self.__dict__.update(state)
         
-        for char in input_dna:
-            if char in bases:
-                result += char
+        if state.get('cg_prefix', 0) is None:
+            self.build_prefix_counts()
+        if state.get('kmer_codes', 0) is None:
+            self.build_specificity_index(k=self.kmer_index_k)
         
-        self.dna_sequence = result
+        '''nearest-neighbour sums that were never built stay unbuilt, unless saved'''
+        if state.get('nn_enthalpy_prefix', 0) is None:
+            tables = self.func_saved_tables(NN_TABLES, max(len(self.dna_sequence), 1))
+            if tables is not None:
+                self.nn_enthalpy_prefix, self.nn_entropy_prefix = tables
+    
+    def clear_cost_cache(self):
+        self.cost_cache.clear()
+        self.cross_dimer_cache.clear()
+    
+    def cost_cache_info(self):
+        return {'hits': self.cost_cache_hits, 'misses': self.cost_cache_misses,
+                'size': len(self.cost_cache), 'max_size': self.cost_cache_size,
+                'cross_dimer_size': len(self.cross_dimer_cache),
+                'cross_dimer_max_size': self.cross_dimer_cache_size}
+    
+    '''input_dna is a str, or a PackedSequence (e.g. memory-mapped from disk)'''
+    '''a PackedSequence is used as it is, without decoding the whole template'''
+    '''characters of a str other than a, t, c, g are deleted; with keep_coordinates'''
+    '''they stay in place as unusable bases (e.g. the Ns of a FASTA record), so'''
+    '''positions match input_dna, and any window holding one costs infinity'''
+    def set_dna_sequence(self, input_dna, keep_coordinates=False):
+        self.unusable_prefix = None
+        
+        if isinstance(input_dna, PackedSequence):
+            self.dna_sequence = input_dna
+            self.dna_codes = input_dna
+        else:
+            '''keep only a, t, c, g, in a single pass (or everything, in place)'''
+            result = input_dna if keep_coordinates else NOT_A_BASE.sub('', input_dna)
+            self.dna_sequence = result
+            self.dna_codes = encode_sequence(result)
+            
+            '''unusable_prefix[i] is the number of unusable bases in dna_sequence[:i]'''
+            unusable = self.dna_codes > 3
+            if unusable.any():
+                self.unusable_prefix = np.concatenate([[0], np.cumsum(unusable)])
+        
+        self.build_prefix_counts()
+        self.nn_enthalpy_prefix = None
+        self.nn_entropy_prefix = None
+        self.build_specificity_index()
+        self.clear_cost_cache()
+    
+    '''tables saved with a packed template (see PackedSequence.save), or None'''
+    '''if the template has none, or they do not have the expected lengths'''
+    def func_saved_tables(self, names, length):
+        if not isinstance(self.dna_codes, PackedSequence):
+            return None
+        
+        tables = tuple(self.dna_codes.load_table(name) for name in names)
+        if any(table is None or len(table) != length for table in tables):
+            return None
+        
+        return tables
+    
+    '''cumulative base counts, so that any window can be scored in O(1)'''
+    '''cg_prefix[i] is the number of Cs and Gs in dna_sequence[:i]'''
+    def build_prefix_counts(self, chunk_size=1 << 20):
+        tables = self.func_saved_tables(PREFIX_TABLES, len(self.dna_sequence)+1)
+        if tables is None:
+            tables = build_prefix_counts(self.dna_codes, chunk_size)
+        
+        self.cg_prefix, self.at_prefix = tables
+    
+    '''cumulative nearest-neighbour stacking sums over the template'''
+    '''nn_enthalpy_prefix[i] sums the stacks between bases j and j+1 for all j < i'''
+    '''built (or mapped from disk) the first time the nearest-neighbour model is used'''
+    def build_nn_prefix(self, chunk_size=1 << 20):
+        tables = self.func_saved_tables(NN_TABLES, max(len(self.dna_sequence), 1))
+        if tables is None:
+            tables = build_nn_prefix(self.dna_codes, chunk_size)
+        
+        self.nn_enthalpy_prefix, self.nn_entropy_prefix = tables
+    
+    '''2-bit codes of dna_sequence[start:stop]'''
+    def func_codes(self, start, stop):
+        return codes_between(self.dna_codes, start, stop)
+    
+    '''sorted k-mer index of dna_sequence (see build_kmer_index); the loci of a'''
+    '''k-mer are found by binary search, and a packed template is never decoded'''
+    def build_specificity_index(self, chunk_size=1 << 20, k=None):
+        if k is None:
+            k = self.index_kmer
+        
+        tables = self.func_saved_tables(kmer_tables(k), max(len(self.dna_sequence)-k+1, 0))
+        if tables is None:
+            tables = build_kmer_index(self.dna_codes, k, chunk_size)
+        
+        self.kmer_codes, self.kmer_positions = tables
+        self.kmer_index_k = k
+    
+    def func_window(self, start, length):
+        return self.dna_sequence[start : start+length]
     
     def func_select_random(self, sqtype='forward', length=20):
+        window = self.func_select_random_window(sqtype=sqtype, length=length)
+        
+        if window is None:
+            return None
+        
+        return self.func_window(*window)
+    
+    '''as func_select_random, but returns the primer as a (start, length) window'''
+    def func_select_random_window(self, sqtype='forward', length=20):
         
         '''ensure length is positive'''
         if length < 1:
@@ -83,11 +738,8 @@ class PrimerDesign(object):
         
         '''choose primer randomly'''
         first_base = random.randint(start_limit, end_limit-length+1)
-        last_base = first_base+length-1
-        
-        result_primer = self.dna_sequence[first_base : last_base+1]
         
-        return result_primer
+        return (first_base, length)
 
     def func_length(self, sq):
         return len(sq)
@@ -109,6 +761,9 @@ class PrimerDesign(object):
         return cg_fraction
     
     def func_temperature(self, sq):
+        if self.tm_model == 'nearest_neighbour':
+            return self.func_nn_temperature(sq)
+        
         no_of_cg = 0
         no_of_at = 0
         
@@ -124,91 +779,210 @@ class PrimerDesign(object):
         annealing_temperature = (4 * no_of_cg) + (2 * no_of_at)
         
         return annealing_temperature
+    
+    '''nearest-neighbour Tm of sq; pairs with other characters are skipped'''
+    def func_nn_temperature(self, sq):
+        if not sq:
+            return 0.
+        
+        enthalpy, entropy = 0., 0.
+        for pair in zip(sq, sq[1:]):
+            dh, ds = NN_PARAMETERS.get(pair[0] + pair[1], (0., 0.))
+            enthalpy += dh
+            entropy += ds
+        for end in (sq[0], sq[-1]):
+            dh, ds = NN_INITIATION.get(end, (0., 0.))
+            enthalpy += dh
+            entropy += ds
+        
+        return nn_melting_temperature(enthalpy, entropy, len(sq), self.na_conc, self.primer_conc)
+    
+    '''window versions of the above, read off the prefix arrays in O(1)'''
+    '''a window is the primer dna_sequence[start : start+length]'''
+    def func_cg_fraction_window(self, start, length):
+        if length < 1:
+            return 0.
+        
+        cg_amt = int(self.cg_prefix[start+length] - self.cg_prefix[start])
+        
+        return cg_amt / length
+    
+    def func_temperature_window(self, start, length):
+        if self.tm_model == 'nearest_neighbour':
+            return self.func_nn_temperature_window(start, length)
+        
+        no_of_cg = int(self.cg_prefix[start+length] - self.cg_prefix[start])
+        no_of_at = int(self.at_prefix[start+length] - self.at_prefix[start])
+        
+        return (4 * no_of_cg) + (2 * no_of_at)
+    
+    '''stacking sums are differences of the prefix arrays; only the two end'''
+    '''bases are looked up, so this is O(1) in the primer length too'''
+    def func_nn_temperature_window(self, start, length):
+        if length < 1:
+            return 0.
+        if self.nn_enthalpy_prefix is None:
+            self.build_nn_prefix()
+        
+        last = start + length - 1
+        enthalpy = self.nn_enthalpy_prefix[last] - self.nn_enthalpy_prefix[start]
+        entropy = self.nn_entropy_prefix[last] - self.nn_entropy_prefix[start]
+        for end in (self.dna_sequence[start], self.dna_sequence[last]):
+            dh, ds = NN_INITIATION.get(end, (0., 0.))
+            enthalpy += dh
+            entropy += ds
+        
+        return nn_melting_temperature(enthalpy, entropy, length, self.na_conc, self.primer_conc)
+    
+    '''annealing temperature of arrays of windows, as an array'''
+    def func_temperature_windows(self, starts, lengths):
+        if self.tm_model == 'nearest_neighbour':
+            if self.nn_enthalpy_prefix is None:
+                self.build_nn_prefix()
+            
+            last = starts + lengths - 1
+            first_codes = codes_at(self.dna_codes, starts) & 3
+            last_codes = codes_at(self.dna_codes, last) & 3
+            enthalpy_prefix = np.asarray(self.nn_enthalpy_prefix)
+            entropy_prefix = np.asarray(self.nn_entropy_prefix)
+            enthalpy = enthalpy_prefix[last] - enthalpy_prefix[starts]
+            enthalpy = enthalpy + NN_INIT_ENTHALPY[first_codes] + NN_INIT_ENTHALPY[last_codes]
+            entropy = entropy_prefix[last] - entropy_prefix[starts]
+            entropy = entropy + NN_INIT_ENTROPY[first_codes] + NN_INIT_ENTROPY[last_codes]
+            
+            return nn_melting_temperature(enthalpy, entropy, lengths, self.na_conc, self.primer_conc)
+        
+        cg_prefix = np.asarray(self.cg_prefix)
+        at_prefix = np.asarray(self.at_prefix)
+        no_of_cg = cg_prefix[starts+lengths] - cg_prefix[starts]
+        no_of_at = at_prefix[starts+lengths] - at_prefix[starts]
+        
+        return (4 * no_of_cg) + (2 * no_of_at)
 
     def func_count_runs(self,sq):
         numruns = 0
-        before = ['at', 'ta', 'ac', 'ca', 'tc', 'ct', 'tg', 'gt', 'cg', 'gc', 'ga', 'ag']
-        after = ['a t', 't a', 'a c', 'c a', 't c', 'c t', 't g', 'g t', 'c g', 'g c', 'g a', 'a g']
-        
-        '''split sq at points where characters change'''
-        for i in range(len(before)):
-            sq = sq.replace(before[i], after[i])
+        run_length = 0
+        previous = ''
         
-        '''split sq at points where a space has been inserted'''
-        sq_list = sq.split()
-        
-        '''each element in sq_list is a run of the same character'''
+        '''a run ends where one base changes to another, or at whitespace'''
         '''count the number of runs that exceed the run_threshold'''
-        for i in sq_list:
-            if len(i) > self.run_threshold:
-                numruns += 1
+        for base in sq:
+            if base.isspace():
+                if run_length > self.run_threshold:
+                    numruns += 1
+                run_length = 0
+                continue
+            
+            if run_length and base != previous and base in BASES and previous in BASES:
+                if run_length > self.run_threshold:
+                    numruns += 1
+                run_length = 0
+            
+            run_length += 1
+            previous = base
+        
+        if run_length > self.run_threshold:
+            numruns += 1
         
         return numruns
 
     def func_count_repeats(self,sq):
         repeats = 0
-        di_repeats = ['at','ac','ag','ca','ct','cg','ga','gt','gc','ta','tc','tg']
         
-        '''find repeats of the two-base sequences in di_repeats'''
-        for item in di_repeats:
-            count = 0
-            for i in range(len(sq)-4):
-                '''example: in tgtgtg, the first and second tg are counted'''
-                '''the third tg is not, so the number of repeats is 2'''
-                if sq[i:i+2] == item and sq[i+2:i+4] == item:
-                    count += 1
-                    j = i+2
-                    while sq[j:j+2] == item and sq[j+2:j+4] == item:
-                        count += 1
-                        j += 2
-                    count = 0
-                    repeats += 1
-                else:
-                    count = 0
+        '''count the positions where a two-base sequence is followed by itself'''
+        '''example: in tgtgtg, the first and second tg are counted'''
+        '''the third tg is not, so the number of repeats is 2'''
+        '''(as before, a repeat ending on the last base is not counted)'''
+        for a, b, c, d in zip(sq, sq[1:], sq[2:], sq[3:len(sq)-1]):
+            if a == c and b == d and a != b and a in BASES and b in BASES:
+                repeats += 1
+        
+        return repeats
+    
+    '''batched versions of func_count_runs and func_count_repeats, for many'''
+    '''windows of dna_sequence at once; starts and lengths are integer arrays'''
+    def func_count_runs_batch(self, starts, lengths):
+        windows, valid = window_matrix(self.dna_codes, starts, lengths)
+        numruns = np.zeros(len(starts), dtype=int)
+        run_length = np.zeros(len(starts), dtype=int)
+        
+        '''a run is counted at the base where its length first exceeds run_threshold'''
+        for i in range(windows.shape[1]):
+            if i == 0:
+                run_length[:] = 1
+            else:
+                run_length = np.where(windows[:, i] == windows[:, i-1], run_length+1, 1)
+            numruns += valid[:, i] & (run_length == self.run_threshold+1)
+        
+        return numruns
+    
+    def func_count_repeats_batch(self, starts, lengths):
+        windows, valid = window_matrix(self.dna_codes, starts, lengths)
+        repeats = np.zeros(len(starts), dtype=int)
+        
+        for i in range(windows.shape[1]-4):
+            is_repeat = (windows[:, i] == windows[:, i+2]) & (windows[:, i+1] == windows[:, i+3])
+            is_repeat &= windows[:, i] != windows[:, i+1]
+            repeats += is_repeat & (i < lengths-4)
         
         return repeats
 
+    '''longest complementary stretch when two copies of sq anneal to each other'''
+    def func_self_dimer(self, sq):
+        return longest_complementary_run(pack_primer(sq), pack_primer(sq[::-1]), len(sq), len(sq))
+    
+    '''longest stem sq can form by folding back on itself'''
+    def func_hairpin(self, sq):
+        return longest_complementary_run(pack_primer(sq), pack_primer(sq[::-1]), len(sq), len(sq),
+                                         min_loop=self.min_hairpin_loop)
+    
+    '''longest complementary stretch between the fp and rp oligos'''
+    '''rp is given on the fp strand, so the oligo is its reverse complement and'''
+    '''the oligo read backwards is simply the complement of rp'''
+    def func_cross_dimer(self, fp, rp):
+        rp_packed, rp_valid = pack_primer(rp)
+        
+        return longest_complementary_run(pack_primer(fp), (rp_packed ^ (3 * rp_valid), rp_valid),
+                                         len(fp), len(rp))
+
+    '''penalty for a value falling outside [min_value, max_value]'''
+    def cost_outside_limits(self, value, min_value, max_value, penalty):
+        if value > max_value:
+            return (value - max_value) * penalty
+        elif value < min_value:
+            return (min_value - value) * penalty
+        else:
+            return 0
+
     '''cost arising from primer length'''
     def cost_length(self, sq):
         sq_len = self.func_length(sq)
         
         '''compare primer length with limits'''
-        if sq_len > self.max_length:
-            return (sq_len - self.max_length) * self.penalty_length
-        elif sq_len < self.min_length:
-            return (self.min_length - sq_len) * self.penalty_length
-        else:
-            return 0
+        return self.cost_outside_limits(sq_len, self.min_length, self.max_length, self.penalty_length)
     
     '''cost arising from primer annealing temperature'''
     def cost_temperature(self, sq):
         sq_temp = self.func_temperature(sq)
         
         '''compare primer annealing temperature with limits'''
-        if sq_temp > self.max_temp:
-            return (sq_temp - self.max_temp) * self.penalty_temp
-        elif sq_temp < self.min_temp:
-            return (self.min_temp - sq_temp) * self.penalty_temp
-        else:
-            return 0
+        return self.cost_outside_limits(sq_temp, self.min_temp, self.max_temp, self.penalty_temp)
     
     '''cost arising from amount of C and G in primer'''
     def cost_cgcontent(self, sq):
         cg_content = self.func_cg_fraction(sq)
         
         '''compare amount of C and G in primer with limits'''
-        if cg_content > self.max_cg:
-            return (cg_content - self.max_cg) * self.penalty_cg
-        elif cg_content < self.min_cg:
-            return (self.min_cg - cg_content) * self.penalty_cg
-        else:
-            return 0
+        return self.cost_outside_limits(cg_content, self.min_cg, self.max_cg, self.penalty_cg)
     
     '''cost arising from difference in annealing temperature of fp and rp'''
     def cost_temperature_difference(self, fp, rp):
         fp_temp = self.func_temperature(fp)
         rp_temp = self.func_temperature(rp)
         
+        return self.cost_tdiff_from_temperatures(fp_temp, rp_temp)
+    
+    def cost_tdiff_from_temperatures(self, fp_temp, rp_temp):
         '''compute temperature difference'''
         t_diff = abs(fp_temp - rp_temp)
         
@@ -218,10 +992,57 @@ class PrimerDesign(object):
         else:
             return 0
     
+    '''number of places in dna_sequence where sq occurs (overlaps included)'''
+    def func_count_occurrences(self, sq):
+        k = self.kmer_index_k
+        sequence = self.dna_sequence
+        
+        '''primers shorter than the index k-mer fall back to scanning'''
+        if len(sq) < k:
+            count = 0
+            i = sequence.find(sq)
+            while i != -1 and sq:
+                count += 1
+                i = sequence.find(sq, i+1)
+            return count
+        
+        '''otherwise only the loci sharing the first k bases need checking'''
+        '''(dna_sequence holds only a, t, c, g, so nothing else can match)'''
+        prefix = sq[:k]
+        if NOT_A_BASE.search(prefix):
+            return 0
+        '''the code is cast to the index dtype, or numpy would widen the whole array'''
+        code = self.kmer_codes.dtype.type(encode_kmer(prefix))
+        first = int(self.kmer_codes.searchsorted(code, side='left'))
+        last = int(self.kmer_codes.searchsorted(code, side='right'))
+        
+        if len(sq) == k:
+            return last - first
+        
+        count = 0
+        for i in self.kmer_positions[first:last].tolist():
+            if sequence.startswith(sq, i):
+                count += 1
+        
+        return count
+    
+    '''number of binding sites of sq, on one or both strands of dna_sequence'''
+    def func_specificity(self, sq):
+        n_positions = self.func_count_occurrences(sq)
+        
+        '''sites on the other strand are occurrences of the reverse complement'''
+        '''a primer that is its own reverse complement was counted already'''
+        if self.specificity_both_strands:
+            sq_rc = reverse_complement(sq)
+            if sq_rc != sq:
+                n_positions += self.func_count_occurrences(sq_rc)
+        
+        return n_positions
+    
     '''cost arising from uniqueness of primer within dna_sequence'''
     def cost_specificity(self, sq):
         '''count number of occurrences of primer'''
-        n_positions = self.dna_sequence.count(sq)
+        n_positions = self.func_specificity(sq)
         
         '''exclude failure because sq not in dna_sequence'''
         if n_positions == 0:
@@ -243,6 +1064,45 @@ class PrimerDesign(object):
         reps = self.func_count_repeats(sq)
         
         return reps * self.penalty_repeats
+    
+    '''cost arising from primer annealing to a copy of itself'''
+    def cost_self_dimer(self, sq):
+        return max(self.func_self_dimer(sq) - self.dimer_threshold, 0) * self.penalty_dimer
+    
+    '''cost arising from primer folding into a hairpin'''
+    def cost_hairpin(self, sq):
+        return max(self.func_hairpin(sq) - self.hairpin_threshold, 0) * self.penalty_hairpin
+    
+    '''cost arising from fp and rp annealing to each other'''
+    def cost_cross_dimer(self, fp, rp):
+        return max(self.func_cross_dimer(fp, rp) - self.dimer_threshold, 0) * self.penalty_dimer
+
+    '''infinite for a window holding an unusable base (see set_dna_sequence)'''
+    def cost_unusable_window(self, start, length):
+        if self.unusable_prefix is not None and self.unusable_prefix[start+length] > self.unusable_prefix[start]:
+            return math.inf
+        
+        return 0
+    
+    '''window versions of the length, cg content and temperature costs'''
+    def cost_length_window(self, start, length):
+        return self.cost_outside_limits(length, self.min_length, self.max_length, self.penalty_length)
+    
+    def cost_temperature_window(self, start, length):
+        sq_temp = self.func_temperature_window(start, length)
+        
+        return self.cost_outside_limits(sq_temp, self.min_temp, self.max_temp, self.penalty_temp)
+    
+    def cost_cgcontent_window(self, start, length):
+        cg_content = self.func_cg_fraction_window(start, length)
+        
+        return self.cost_outside_limits(cg_content, self.min_cg, self.max_cg, self.penalty_cg)
+    
+    def cost_temperature_difference_window(self, fp_start, fp_length, rp_start, rp_length):
+        fp_temp = self.func_temperature_window(fp_start, fp_length)
+        rp_temp = self.func_temperature_window(rp_start, rp_length)
+        
+        return self.cost_tdiff_from_temperatures(fp_temp, rp_temp)
 
     def calculate_values(self, fp, rp):
         values_dict = {}
@@ -254,12 +1114,17 @@ class PrimerDesign(object):
         values_dict['Annealing temp. (fp)'] = self.func_temperature(fp)
         values_dict['Annealing temp. (rp)'] = self.func_temperature(rp)
         values_dict['Temp. difference'] = abs(values_dict['Annealing temp. (fp)']-values_dict['Annealing temp. (rp)'])
-        values_dict['Specificity (fp)'] = self.dna_sequence.count(fp)
-        values_dict['Specificity (rp)'] = self.dna_sequence.count(fp)
+        values_dict['Specificity (fp)'] = self.func_specificity(fp)
+        values_dict['Specificity (rp)'] = self.func_specificity(rp)
         values_dict['Runs (fp)'] = self.func_count_runs(fp)
         values_dict['Runs (rp)'] = self.func_count_runs(rp)
         values_dict['Repeats (fp)'] = self.func_count_repeats(fp)
         values_dict['Repeats (rp)'] = self.func_count_repeats(rp)
+        values_dict['Self-dimer (fp)'] = self.func_self_dimer(fp)
+        values_dict['Self-dimer (rp)'] = self.func_self_dimer(rp)
+        values_dict['Hairpin (fp)'] = self.func_hairpin(fp)
+        values_dict['Hairpin (rp)'] = self.func_hairpin(rp)
+        values_dict['Cross-dimer'] = self.func_cross_dimer(fp, rp)
         
         return values_dict
     
@@ -279,6 +1144,11 @@ class PrimerDesign(object):
         cost_dict['Runs (rp)'] = self.cost_runs(rp)
         cost_dict['Repeats (fp)'] = self.cost_repeats(fp)
         cost_dict['Repeats (rp)'] = self.cost_repeats(rp)
+        cost_dict['Self-dimer (fp)'] = self.cost_self_dimer(fp)
+        cost_dict['Self-dimer (rp)'] = self.cost_self_dimer(rp)
+        cost_dict['Hairpin (fp)'] = self.cost_hairpin(fp)
+        cost_dict['Hairpin (rp)'] = self.cost_hairpin(rp)
+        cost_dict['Cross-dimer'] = self.cost_cross_dimer(fp, rp)
         
         return cost_dict
     
@@ -291,6 +1161,109 @@ class PrimerDesign(object):
         
         return score
 
+    '''same as calculate_costs, but for primers given as windows of dna_sequence'''
+    '''length, cg content and temperature terms are O(1) regardless of primer length'''
+    def calculate_costs_window(self, fp_start, fp_length, rp_start, rp_length):
+        fp = self.func_window(fp_start, fp_length)
+        rp = self.func_window(rp_start, rp_length)
+        cost_dict = {}
+        
+        cost_dict['Length (fp)'] = self.cost_length_window(fp_start, fp_length)
+        cost_dict['Length (rp)'] = self.cost_length_window(rp_start, rp_length)
+        cost_dict['Unusable bases (fp)'] = self.cost_unusable_window(fp_start, fp_length)
+        cost_dict['Unusable bases (rp)'] = self.cost_unusable_window(rp_start, rp_length)
+        cost_dict['% CG content (fp)'] = self.cost_cgcontent_window(fp_start, fp_length)
+        cost_dict['% CG content (rp)'] = self.cost_cgcontent_window(rp_start, rp_length)
+        cost_dict['Annealing temp. (fp)'] = self.cost_temperature_window(fp_start, fp_length)
+        cost_dict['Annealing temp. (rp)'] = self.cost_temperature_window(rp_start, rp_length)
+        cost_dict['Temp. difference'] = self.cost_temperature_difference_window(fp_start, fp_length, rp_start, rp_length)
+        cost_dict['Specificity (fp)'] = self.cost_specificity(fp)
+        cost_dict['Specificity (rp)'] = self.cost_specificity(rp)
+        cost_dict['Runs (fp)'] = self.cost_runs(fp)
+        cost_dict['Runs (rp)'] = self.cost_runs(rp)
+        cost_dict['Repeats (fp)'] = self.cost_repeats(fp)
+        cost_dict['Repeats (rp)'] = self.cost_repeats(rp)
+        cost_dict['Self-dimer (fp)'] = self.cost_self_dimer(fp)
+        cost_dict['Self-dimer (rp)'] = self.cost_self_dimer(rp)
+        cost_dict['Hairpin (fp)'] = self.cost_hairpin(fp)
+        cost_dict['Hairpin (rp)'] = self.cost_hairpin(rp)
+        cost_dict['Cross-dimer'] = self.cost_cross_dimer(fp, rp)
+        
+        return cost_dict
+    
+    def cost_objective_function_window(self, fp_start, fp_length, rp_start, rp_length):
+        cost_dict = self.calculate_costs_window(fp_start, fp_length, rp_start, rp_length)
+        
+        return sum(cost_dict.values())
+    
+    '''sum of the terms of calculate_costs_window that depend on one primer only'''
+    def cost_primer_window(self, start, length):
+        return self.func_window_entry(start, length)[0]
+    
+    '''(cost_primer_window, pack_primer of the window) for a window'''
+    '''a window seen recently is answered from cost_cache'''
+    def func_window_entry(self, start, length):
+        key = (start, length)
+        cache = self.cost_cache
+        
+        entry = cache.get(key)
+        if entry is not None:
+            cache.move_to_end(key)
+            self.cost_cache_hits += 1
+            return entry
+        
+        self.cost_cache_misses += 1
+        sq = self.func_window(start, length)
+        packed = pack_primer(sq)
+        reversed_packed = pack_primer(sq[::-1])
+        
+        cost = self.cost_length_window(start, length)
+        cost += self.cost_unusable_window(start, length)
+        cost += self.cost_cgcontent_window(start, length)
+        cost += self.cost_temperature_window(start, length)
+        cost += self.cost_specificity(sq)
+        cost += self.cost_runs(sq)
+        cost += self.cost_repeats(sq)
+        
+        '''self-dimer and hairpin, reusing the packed primer'''
+        self_dimer = longest_complementary_run(packed, reversed_packed, length, length,
+                                               at_least=self.dimer_threshold)
+        hairpin = longest_complementary_run(packed, reversed_packed, length, length,
+                                            min_loop=self.min_hairpin_loop, at_least=self.hairpin_threshold)
+        cost += max(self_dimer - self.dimer_threshold, 0) * self.penalty_dimer
+        cost += max(hairpin - self.hairpin_threshold, 0) * self.penalty_hairpin
+        
+        '''evict the least recently used windows beyond the size bound'''
+        entry = (cost, packed)
+        cache[key] = entry
+        while len(cache) > self.cost_cache_size:
+            cache.popitem(last=False)
+        
+        return entry
+    
+    '''cost_cross_dimer of two windows, from their cached packed forms'''
+    '''a pair seen recently is answered from cross_dimer_cache'''
+    def cost_cross_dimer_window(self, fp, rp):
+        key = (fp, rp)
+        cache = self.cross_dimer_cache
+        
+        cost = cache.get(key)
+        if cost is not None:
+            cache.move_to_end(key)
+            return cost
+        
+        fp_packed = self.func_window_entry(*fp)[1]
+        rp_packed, rp_valid = self.func_window_entry(*rp)[1]
+        run = longest_complementary_run(fp_packed, (rp_packed ^ (3 * rp_valid), rp_valid), fp[1], rp[1],
+                                        at_least=self.dimer_threshold)
+        cost = (run - self.dimer_threshold) * self.penalty_dimer
+        
+        cache[key] = cost
+        while len(cache) > self.cross_dimer_cache_size:
+            cache.popitem(last=False)
+        
+        return cost
+
     def cost_objective_function_info(self, fp, rp):
         print("===============================================")
         print("{:^47}\n{:^47}".format("Bio-DW 2D", "Primer Cost Report"))
@@ -321,9 +1294,10 @@ class PrimerDesign(object):
             if cost_dict[key] < 1e-3:
                 print('{:<25}{:>11.2f}{:>11.2f}'.format(key, values_dict[key], cost_dict[key]))
 
-    def get_primer_neighbour(self, current_primer):
+    '''primers are passed around as (start, length) windows of dna_sequence'''
+    def get_primer_neighbour(self, current_window):
         '''obtain position of current primer'''
-        current_index = self.dna_sequence.find(current_primer)
+        current_index = current_window[0]
         
         '''generate new primer randomly'''
         '''choose length within desirable range, no point exceeding'''
@@ -335,71 +1309,784 @@ class PrimerDesign(object):
             first_base = random.randint(current_index-10, current_index+10)
         
         '''select neighbouring primer'''
-        last_base = first_base+new_length-1
-        result_primer = self.dna_sequence[first_base : last_base+1]
+        return (first_base, new_length)
+    
+    '''a search state is (fp, rp, cost, fp_cost, rp_cost)'''
+    '''fp_cost and rp_cost are the terms that depend on that primer alone'''
+    def func_new_state(self, fp, rp):
+        fp_cost = self.cost_primer_window(*fp)
+        rp_cost = self.cost_primer_window(*rp)
+        
+        return self.func_combine_state(fp, rp, fp_cost, rp_cost)
+    
+    def func_combine_state(self, fp, rp, fp_cost, rp_cost):
+        '''the temperature difference and cross-dimer are the terms coupling fp and rp'''
+        tdiff_cost = self.cost_tdiff_from_temperatures(self.func_temperature_window(*fp),
+                                                       self.func_temperature_window(*rp))
+        pair_cost = tdiff_cost + self.cost_cross_dimer_window(fp, rp)
+        
+        return (fp, rp, fp_cost + rp_cost + pair_cost, fp_cost, rp_cost)
+    
+    '''move either fp or rp to a neighbouring window, never both'''
+    '''only the moved primer's terms and the temp. difference are recomputed'''
+    def func_propose_move(self, state):
+        fp, rp, cost, fp_cost, rp_cost = state
+        
+        if random.random() < 0.5:
+            fp = self.get_primer_neighbour(fp)
+            fp_cost = self.cost_primer_window(*fp)
+        else:
+            rp = self.get_primer_neighbour(rp)
+            rp_cost = self.cost_primer_window(*rp)
+        
+        return self.func_combine_state(fp, rp, fp_cost, rp_cost)
+    
+    '''Metropolis criterion for a change in cost of delta at the given temperature'''
+    def func_accept(self, delta, temperature):
+        '''step 3 - if new solution has lower cost, accept immediately'''
+        '''(between two unusable windows delta is inf - inf, i.e. nan: accept too,'''
+        '''so that a walk can leave a stretch of unusable bases)'''
+        if delta < 0 or math.isnan(delta):
+            return True
         
-        return result_primer
+        '''step 4a - calculate an acceptance probability'''
+        acceptance_probability = math.exp(-delta / temperature)
+        
+        '''step 4b - roll die'''
+        num = random.random()
+        
+        '''step 4c - check if accept new solution'''
+        return acceptance_probability > num
     
-    def func_simulated_annealing(self):
+    '''n_steps Metropolis moves at a fixed temperature, starting from state'''
+    '''returns the final state, the best state seen and the no. of accepted moves'''
+    def func_fixed_temperature_walk(self, state, temperature, n_steps):
+        best = state
+        accepted = 0
+        
+        for step in range(n_steps):
+            new_state = self.func_propose_move(state)
+            
+            if self.func_accept(new_state[2] - state[2], temperature):
+                state = new_state
+                accepted += 1
+                if state[2] < best[2]:
+                    best = state
+        
+        return state, best, accepted
+
+    '''returns (fp, rp, cost, no. of iterations) of the best solution found, which'''
+    '''need not be the state the chain ended in'''
+    '''fp and rp are (start, length) windows of dna_sequence'''
+    '''seed makes the chain reproducible; verbose=False suppresses all printing'''
+    '''telemetry is an AnnealingTelemetry; by default progress is printed at most'''
+    '''once a second when verbose, and not at all otherwise'''
+    def func_simulated_annealing(self, seed=None, verbose=True, telemetry=None):
+        if seed is not None:
+            random.seed(seed)
+        if telemetry is None:
+            telemetry = AnnealingTelemetry(progress='throttled' if verbose else 'silent')
+        
         '''step 1.1 - decide simulation parameters'''
         temperature = self.initial_temperature
         stopping_temperature = self.stopping_temperature
-        drop = self.drop_fraction
+        schedule = self.cooling_schedule
+        if schedule is None:
+            schedule = GeometricCooling(self.drop_fraction)
+        schedule.start(temperature)
         
-        print("=== Simulation parameters ===")
-        print("Initial temperature: {}\nStopping temperature: {}\nDrop Fraction: {}"
-                  .format(temperature, stopping_temperature, drop))
+        if verbose:
+            print("=== Simulation parameters ===")
+            print("Initial temperature: {}\nStopping temperature: {}\nCooling schedule: {}"
+                      .format(temperature, stopping_temperature, type(schedule).__name__))
         
         '''step 1.2 - start by choosing possible solution'''
-        fp_current = self.func_select_random(sqtype='forward', length = 20)
-        rp_current = self.func_select_random(sqtype='reverse', length = 20)
-        cost = self.cost_objective_function(fp_current, rp_current)
-        current_cost = cost
+        fp_current = self.func_select_random_window(sqtype='forward', length = 20)
+        rp_current = self.func_select_random_window(sqtype='reverse', length = 20)
+        current = self.func_new_state(fp_current, rp_current)
         
-        print("Initial FP (random): {}\nInitial RP (random): {}\nCost: {}\n"
-                  .format(fp_current, rp_current, current_cost))
+        if verbose:
+            print("Initial FP (random): {}\nInitial RP (random): {}\nCost: {}\n"
+                      .format(self.func_window(*fp_current), self.func_window(*rp_current), current[2]))
         
         i = 0 #to count iterations completed
+        telemetry.start(self, temperature, current[2])
+        start_time = time.time()
+        best = current
+        last_improvement = 0
+        acceptance_rate = 1.
+        self.stop_reason = 'stopping temperature'
         
         while temperature > stopping_temperature:
+            '''0 is not used in case of floating-point error'''
+            if self.stop_at_zero_cost and current[2] < 1e-3:
+                self.stop_reason = 'zero cost'
+                break
+            if self.stall_iterations is not None and i - last_improvement >= self.stall_iterations:
+                self.stop_reason = 'stalled'
+                break
+            if self.time_budget is not None and time.time() - start_time > self.time_budget:
+                self.stop_reason = 'time budget'
+                break
+            
             i += 1
             '''step 2 - obtain new possible solution'''
-            fp_new = self.get_primer_neighbour(fp_current)
-            rp_new = self.get_primer_neighbour(rp_current)
-            print("Running iteration {:>4}: fp ({:<22}), rp ({:<22})"
-                      .format(i, fp_new, rp_new))
-            new_cost = self.cost_objective_function(fp_new, rp_new)
+            new = self.func_propose_move(current)
             
-            '''step 3 - if new solution has lower cost, accept immediately'''
-            if new_cost < current_cost:
-                fp_current = fp_new
-                rp_current = rp_new
-                current_cost = new_cost
+            '''steps 3 and 4 - decide whether to move to the new solution'''
+            accepted = self.func_accept(new[2] - current[2], temperature)
+            if accepted:
+                current = new
+                if current[2] < best[2]:
+                    best = current
+                    last_improvement = i
+            telemetry.update(i, temperature, current, accepted)
             
-            else:
-                '''step 4a - calculate an acceptance probability'''
-                delta = new_cost - current_cost
-                acceptance_probability = math.exp(-delta / temperature)
+            '''lower the temperature as the schedule dictates'''
+            acceptance_rate = 0.99 * acceptance_rate + 0.01 * accepted
+            temperature = schedule.next_temperature(temperature, acceptance_rate)
+        
+        telemetry.finish()
+        fp_best, rp_best, best_cost = best[:3]
+        
+        '''after arriving at solution, display results'''
+        if verbose:
+            fp, rp = self.func_window(*fp_best), self.func_window(*rp_best)
+            print("\n=== Best solution ===")
+            print("Forward primer: {}\nReverse primer: {}\nCost: {}"
+                      .format(fp, rp, best_cost))
+            print("No. of iterations: {}".format(i))
+            print("Stopped by: {}".format(self.stop_reason))
+            print("\nDetails:")
+            self.cost_objective_function_info(fp, rp)
+        
+        return fp_best, rp_best, best_cost, i
+    
+    '''run n_chains independent annealing chains with distinct seeds in a process pool'''
+    '''returns the best chain's (fp, rp, cost) and a list of per-chain statistics'''
+    '''with trace_dir set, each chain saves its trace there as chain_<seed>.npz'''
+    def func_parallel_annealing(self, n_chains=None, processes=None, base_seed=None, verbose=True,
+                                trace_dir=None):
+        if processes is None:
+            processes = cpu_count()
+        if n_chains is None:
+            n_chains = processes
+        if base_seed is None:
+            base_seed = random.randrange(2**31)
+        
+        seeds = [base_seed + n for n in range(n_chains)]
+        
+        if verbose:
+            print("=== Parallel annealing ===")
+            print("Chains: {}\nProcesses: {}\nSeeds: {}..{}\n"
+                      .format(n_chains, processes, seeds[0], seeds[-1]))
+        
+        '''each worker receives a copy of this object once, not once per chain'''
+        start_time = time.time()
+        with Pool(processes, initializer=init_annealing_worker, initargs=(self,)) as pool:
+            chain_stats = pool.map(run_annealing_chain, [(seed, trace_dir) for seed in seeds])
+        wall_time = time.time() - start_time
+        
+        best = min(chain_stats, key=lambda stats: stats['cost'])
+        
+        if verbose:
+            print("{:>12}{:>10}{:>12}{:>10}".format("Seed", "Cost", "Iterations", "Time (s)"))
+            for stats in chain_stats:
+                print("{:>12}{:>10.2f}{:>12}{:>10.2f}"
+                          .format(stats['seed'], stats['cost'], stats['iterations'], stats['time']))
+            print("\nWall time: {:.2f}s".format(wall_time))
+            fp, rp = self.func_window(*best['fp']), self.func_window(*best['rp'])
+            print("\n=== Best solution (seed {}) ===".format(best['seed']))
+            print("Forward primer: {}\nReverse primer: {}\nCost: {}"
+                      .format(fp, rp, best['cost']))
+            print("\nDetails:")
+            self.cost_objective_function_info(fp, rp)
+        
+        return (best['fp'], best['rp'], best['cost']), chain_stats
+    
+    '''replica exchange (parallel tempering): n_replicas walks at fixed temperatures,'''
+    '''spaced geometrically from stopping_temperature to initial_temperature'''
+    '''each round every replica makes swap_interval moves in a worker process,'''
+    '''then neighbouring temperatures try to exchange their states'''
+    '''n_replicas must be at least 2, one at each end of the temperature range,'''
+    '''and n_rounds at least 1'''
+    def func_parallel_tempering(self, n_replicas=None, processes=None, n_rounds=40,
+                                swap_interval=25, seed=None, verbose=True):
+        if processes is None:
+            processes = cpu_count()
+        if n_replicas is None:
+            n_replicas = max(processes, 2)
+        if n_replicas < 2:
+            raise ValueError('parallel tempering needs at least 2 replicas, not {}'.format(n_replicas))
+        if n_rounds < 1:
+            raise ValueError('parallel tempering needs at least 1 round, not {}'.format(n_rounds))
+        if seed is None:
+            seed = random.randrange(2**31)
+        random.seed(seed)
+        
+        ratio = self.initial_temperature / self.stopping_temperature
+        temperatures = [self.stopping_temperature * ratio ** (n / (n_replicas-1)) for n in range(n_replicas)]
+        
+        '''every replica starts from its own random solution'''
+        states = []
+        for n in range(n_replicas):
+            fp = self.func_select_random_window(sqtype='forward', length=20)
+            rp = self.func_select_random_window(sqtype='reverse', length=20)
+            states.append(self.func_new_state(fp, rp))
+        best = min(states, key=lambda state: state[2])
+        
+        if verbose:
+            print("=== Parallel tempering ===")
+            print("Replicas: {}\nProcesses: {}\nSeed: {}".format(n_replicas, processes, seed))
+            print("Temperatures: {}\n".format(', '.join('{:.3g}'.format(t) for t in temperatures)))
+        
+        moves_accepted = [0] * n_replicas
+        swaps_tried = [0] * (n_replicas-1)
+        swaps_accepted = [0] * (n_replicas-1)
+        evaluations = n_replicas
+        
+        start_time = time.time()
+        with Pool(processes, initializer=init_annealing_worker, initargs=(self,)) as pool:
+            for r in range(n_rounds):
+                tasks = [(states[n], temperatures[n], swap_interval, seed + (r * n_replicas + n + 1))
+                         for n in range(n_replicas)]
+                walks = pool.map(run_tempering_replica, tasks)
+                evaluations += n_replicas * swap_interval
+                
+                for n, (state, walk_best, accepted) in enumerate(walks):
+                    states[n] = state
+                    moves_accepted[n] += accepted
+                    if walk_best[2] < best[2]:
+                        best = walk_best
                 
-                '''step 4b - roll die'''
-                num = random.random()
+                '''exchange states between neighbouring temperatures, alternating pairs'''
+                for n in range(r % 2, n_replicas-1, 2):
+                    swaps_tried[n] += 1
+                    delta = (1/temperatures[n] - 1/temperatures[n+1]) * (states[n][2] - states[n+1][2])
+                    if delta >= 0 or random.random() < math.exp(delta):
+                        states[n], states[n+1] = states[n+1], states[n]
+                        swaps_accepted[n] += 1
                 
-                '''step 4c - check if accept new solution'''
-                if acceptance_probability > num:
-                    fp_current = fp_new
-                    rp_current = rp_new
-                    current_cost = new_cost
+                if verbose:
+                    print("Round {:>4}: best cost {:>8.2f}, replica costs {}"
+                              .format(r+1, best[2], ' '.join('{:.2f}'.format(state[2]) for state in states)))
+                
+                '''0 is not used in case of floating-point error'''
+                if self.stop_at_zero_cost and best[2] < 1e-3:
+                    break
+        wall_time = time.time() - start_time
+        
+        stats = {'temperatures': temperatures,
+                 'rounds': r+1,
+                 'evaluations': evaluations,
+                 'move_acceptance': [a / ((r+1) * swap_interval) for a in moves_accepted],
+                 'swap_acceptance': [a / t if t else 0. for a, t in zip(swaps_accepted, swaps_tried)],
+                 'time': wall_time}
+        
+        if verbose:
+            fp, rp = self.func_window(*best[0]), self.func_window(*best[1])
+            print("\n=== Final solution ===")
+            print("Forward primer: {}\nReverse primer: {}\nCost: {}".format(fp, rp, best[2]))
+            print("Rounds: {}\nEvaluations: {}\nWall time: {:.2f}s".format(r+1, evaluations, wall_time))
+            print("\nDetails:")
+            self.cost_objective_function_info(fp, rp)
+        
+        return best[:3], stats
+
+    '''every window a primer of the given type can be chosen from, as arrays'''
+    '''same limits as func_select_random, for every length in the length range'''
+    def func_candidate_windows(self, sqtype='forward'):
+        if(sqtype == 'forward'):
+            start_limit = self.fp_start
+            end_limit = self.fp_end
+        elif(sqtype == 'reverse'):
+            start_limit = self.rp_start
+            end_limit = self.rp_end
+        else:
+            return None
+        
+        starts = [np.empty(0, dtype=int)]
+        lengths = [np.empty(0, dtype=int)]
+        for length in range(self.min_length, self.max_length+1):
+            last_start = min(end_limit-length+1, len(self.dna_sequence)-length)
+            window_starts = np.arange(start_limit, last_start+1)
+            starts.append(window_starts)
+            lengths.append(np.full(len(window_starts), length))
+        
+        return np.concatenate(starts), np.concatenate(lengths)
+    
+    '''cost of each window on its own (every term except temp. difference)'''
+    '''returns the costs together with the annealing temperature of each window'''
+    def cost_windows(self, starts, lengths):
+        if len(starts) == 0:
+            return np.empty(0), np.empty(0)
+        
+        cg_prefix = np.asarray(self.cg_prefix)
+        no_of_cg = cg_prefix[starts+lengths] - cg_prefix[starts]
+        temps = self.func_temperature_windows(starts, lengths)
+        
+        costs = cost_outside_limits_array(lengths, self.min_length, self.max_length, self.penalty_length)
+        costs = costs + cost_outside_limits_array(no_of_cg / lengths, self.min_cg, self.max_cg, self.penalty_cg)
+        costs = costs + cost_outside_limits_array(temps, self.min_temp, self.max_temp, self.penalty_temp)
+        
+        costs = costs + self.func_count_runs_batch(starts, lengths) * self.penalty_runs
+        costs = costs + self.func_count_repeats_batch(starts, lengths) * self.penalty_repeats
+        
+        if self.unusable_prefix is not None:
+            unusable = self.unusable_prefix[starts+lengths] > self.unusable_prefix[starts]
+            costs = np.where(unusable, math.inf, costs)
+        
+        '''specificity, self-dimer and hairpin are scored window by window'''
+        sequence_costs = []
+        for start, length in zip(starts.tolist(), lengths.tolist()):
+            sq = self.func_window(start, length)
+            sequence_costs.append(self.cost_specificity(sq) + self.cost_self_dimer(sq) + self.cost_hairpin(sq))
+        costs = costs + np.array(sequence_costs, dtype=float)
+        
+        return costs, temps
+    
+    '''the n pairs with the lowest cost without the cross-dimer term, i.e. a lower'''
+    '''bound on their cost; the temperature difference is the only other term that'''
+    '''couples fp and rp, so the pair costs are a broadcast sum over blocks of fp'''
+    def func_best_pairs_without_cross_dimer(self, fp_costs, fp_temps, rp_costs, rp_temps, n, block_size=256):
+        best_costs = np.empty(0)
+        best_fp = np.empty(0, dtype=int)
+        best_rp = np.empty(0, dtype=int)
+        if n < 1 or len(rp_costs) == 0:
+            return best_costs, best_fp, best_rp
+        
+        for b in range(0, len(fp_costs), block_size):
+            t_diff = np.abs(fp_temps[b:b+block_size, None] - rp_temps[None, :])
+            total = fp_costs[b:b+block_size, None] + rp_costs[None, :]
+            total = total + np.maximum(t_diff - self.max_tdiff, 0) * self.penalty_tdiff
+            
+            '''keep the best n of this block, then merge with those found so far'''
+            flat = total.ravel()
+            k = min(n, len(flat))
+            block_best = np.argpartition(flat, k-1)[:k]
+            best_costs = np.concatenate([best_costs, flat[block_best]])
+            best_fp = np.concatenate([best_fp, b + block_best // total.shape[1]])
+            best_rp = np.concatenate([best_rp, block_best % total.shape[1]])
             
-            '''decrease temperature by a small factor'''
-            temperature *= drop
+            order = np.lexsort((best_rp, best_fp, best_costs))[:n]
+            best_costs = best_costs[order]
+            best_fp = best_fp[order]
+            best_rp = best_rp[order]
         
-        '''after arriving at solution, display results'''
-        print("\n=== Final solution ===")
-        print("Forward primer: {}\nReverse primer: {}\nCost: {}"
-                  .format(fp_current, rp_current, current_cost))
-        print("No. of iterations: {}".format(i))
-        print("\nDetails:")
-        self.cost_objective_function_info(fp_current, rp_current)
+        return best_costs, best_fp, best_rp
+    
+    '''score every fp window against every rp window and keep the best top_k pairs'''
+    '''every term but the pair terms is computed once per window; the cross-dimer'''
+    '''term is only computed for the pairs whose lower bound could make the top_k'''
+    '''returns an empty list if either region is too short to hold a primer'''
+    def func_exhaustive_search(self, top_k=10, block_size=256, verbose=True):
+        fp_starts, fp_lengths = self.func_candidate_windows(sqtype='forward')
+        rp_starts, rp_lengths = self.func_candidate_windows(sqtype='reverse')
+        if len(fp_starts) == 0 or len(rp_starts) == 0 or top_k < 1:
+            if verbose:
+                print("=== Exhaustive search ===")
+                print("No candidate pairs: FP candidates {}, RP candidates {}"
+                          .format(len(fp_starts), len(rp_starts)))
+            return []
+        
+        fp_costs, fp_temps = self.cost_windows(fp_starts, fp_lengths)
+        rp_costs, rp_temps = self.cost_windows(rp_starts, rp_lengths)
+        n_pairs = len(fp_costs) * len(rp_costs)
+        
+        if verbose:
+            print("=== Exhaustive search ===")
+            print("FP candidates: {}\nRP candidates: {}\nPairs scored: {}\n"
+                      .format(len(fp_costs), len(rp_costs), n_pairs))
+        
+        '''widen the candidate list until the top_k exact costs are no higher than'''
+        '''the lower bound of every pair left out'''
+        n = 4 * top_k
+        while True:
+            bounds, best_fp, best_rp = self.func_best_pairs_without_cross_dimer(
+                fp_costs, fp_temps, rp_costs, rp_temps, n, block_size)
+            pairs = []
+            for bound, i, j in zip(bounds.tolist(), best_fp.tolist(), best_rp.tolist()):
+                fp = (int(fp_starts[i]), int(fp_lengths[i]))
+                rp = (int(rp_starts[j]), int(rp_lengths[j]))
+                pairs.append((bound + self.cost_cross_dimer_window(fp, rp), i, j))
+            pairs.sort()
+            pairs = pairs[:top_k]
+            if n >= n_pairs or (len(pairs) == top_k and pairs[-1][0] <= bounds[-1]):
+                break
+            n *= 4
+        best_fp = np.array([i for cost, i, j in pairs], dtype=int)
+        best_rp = np.array([j for cost, i, j in pairs], dtype=int)
+        
+        '''report each pair with the same objective function used elsewhere'''
+        results = []
+        for i, j in zip(best_fp.tolist(), best_rp.tolist()):
+            fp = (int(fp_starts[i]), int(fp_lengths[i]))
+            rp = (int(rp_starts[j]), int(rp_lengths[j]))
+            results.append((self.cost_objective_function_window(*fp, *rp), fp, rp))
+        
+        if verbose:
+            print("=== Top {} primer pairs ===".format(len(results)))
+            print("{:>4}{:>10}  {:<24}{:<24}".format("Rank", "Cost", "Forward primer", "Reverse primer"))
+            for rank, (cost, fp, rp) in enumerate(results, start=1):
+                print("{:>4}{:>10.2f}  {:<24}{:<24}"
+                          .format(rank, cost, self.func_window(*fp), self.func_window(*rp)))
+            print("\nDetails:")
+            self.cost_objective_function_info(self.func_window(*results[0][1]), self.func_window(*results[0][2]))
+        
+        return results
+    
+    '''the k-mers of the fp oligo and of the rp oligo (reverse complement of rp)'''
+    '''two oligos have a complementary run of k bases exactly when one shares a'''
+    '''k-mer with the reverse complement of the other'''
+    def func_pair_kmers(self, fp, rp, k):
+        kmers = set()
+        for oligo in (fp, reverse_complement(rp)):
+            for i in range(len(oligo) - k + 1):
+                kmer = oligo[i:i+k]
+                if not NOT_A_BASE.search(kmer):
+                    kmers.add(kmer)
+        
+        return kmers
+    
+    '''the best n_candidates pairs of each target, as found by func_exhaustive_search'''
+    '''targets maps a name to its (fp_start, fp_end, rp_start, rp_end) regions'''
+    '''each candidate is (cost, fp_window, rp_window, lowest Tm, highest Tm, k-mers)'''
+    def func_multiplex_candidates(self, targets, n_candidates):
+        regions = (self.fp_start, self.fp_end, self.rp_start, self.rp_end)
+        k = self.dimer_threshold + 1
+        candidates = {}
+        
+        try:
+            for name, region in targets.items():
+                self.fp_start, self.fp_end, self.rp_start, self.rp_end = region
+                candidates[name] = []
+                for cost, fp, rp in self.func_exhaustive_search(top_k=n_candidates, verbose=False):
+                    temps = (self.func_temperature_window(*fp), self.func_temperature_window(*rp))
+                    kmers = self.func_pair_kmers(self.func_window(*fp), self.func_window(*rp), k)
+                    candidates[name].append((cost, fp, rp, min(temps), max(temps), kmers))
+        finally:
+            self.fp_start, self.fp_end, self.rp_start, self.rp_end = regions
+        
+        return candidates
+    
+    '''design one pair per target so that the whole panel can run in one tube'''
+    '''the panel minimises the summed pair costs, subject to every primer lying'''
+    '''within multiplex_max_tdiff of every other and no dimer between pairs'''
+    '''longer than dimer_threshold'''
+    '''branch and bound over the per-target candidate lists: choosing a pair blocks,'''
+    '''through a k-mer index, every candidate of other targets it would dimerise'''
+    '''with; the target with fewest candidates left is filled next, and a branch is'''
+    '''dropped once its cost plus the cheapest open candidate of each remaining'''
+    '''target cannot beat the best panel found; max_nodes bounds the search'''
+    def func_multiplex_design(self, targets, n_candidates=None, max_nodes=200000, verbose=True):
+        if n_candidates is None:
+            n_candidates = self.multiplex_candidates
+        start_time = time.time()
+        
+        candidates = self.func_multiplex_candidates(targets, n_candidates)
+        names = list(candidates)
+        
+        '''flatten the candidates; each list stays sorted by cost'''
+        pairs = []
+        target_of = []
+        by_target = []
+        for t, name in enumerate(names):
+            ids = []
+            for candidate in candidates[name]:
+                ids.append(len(pairs))
+                pairs.append(candidate)
+                target_of.append(t)
+            by_target.append(ids)
+        
+        '''k-mer -> candidates containing it'''
+        kmer_index = {}
+        for c, pair in enumerate(pairs):
+            for kmer in pair[5]:
+                kmer_index.setdefault(kmer, []).append(c)
+        
+        '''candidates of other targets that c would form a dimer with, built on first use'''
+        conflicts = {}
+        def func_conflicts(c):
+            if c not in conflicts:
+                clashing = set()
+                for kmer in pairs[c][5]:
+                    for d in kmer_index.get(reverse_complement(kmer), ()):
+                        if target_of[d] != target_of[c]:
+                            clashing.add(d)
+                conflicts[c] = clashing
+            return conflicts[c]
+        
+        blocked = [0] * len(pairs)
+        band = self.multiplex_max_tdiff
+        chosen = []
+        best = {'cost': math.inf, 'panel': None}
+        stats = {'nodes': 0, 'pruned': 0}
+        
+        '''the band holds every primer chosen so far and the candidate's own pair'''
+        def func_open(t, low, high):
+            return [c for c in by_target[t]
+                    if not blocked[c] and pairs[c][4] - min(low, pairs[c][3]) <= band
+                    and max(high, pairs[c][4]) - pairs[c][3] <= band]
+        
+        def func_search(remaining, low, high, cost):
+            stats['nodes'] += 1
+            if not remaining:
+                if cost < best['cost']:
+                    best['cost'] = cost
+                    best['panel'] = list(chosen)
+                return
+            if stats['nodes'] > max_nodes:
+                return
+            
+            '''bound, and pick the most constrained target'''
+            bound = cost
+            next_target = None
+            next_open = None
+            for t in remaining:
+                open_ids = func_open(t, low, high)
+                if not open_ids:
+                    stats['pruned'] += 1
+                    return
+                bound += pairs[open_ids[0]][0]
+                if next_open is None or len(open_ids) < len(next_open):
+                    next_target, next_open = t, open_ids
+            if bound >= best['cost']:
+                stats['pruned'] += 1
+                return
+            
+            rest = [t for t in remaining if t != next_target]
+            for c in next_open:
+                if blocked[c]:
+                    continue
+                clashing = func_conflicts(c)
+                for d in clashing:
+                    blocked[d] += 1
+                chosen.append(c)
+                
+                func_search(rest, min(low, pairs[c][3]), max(high, pairs[c][4]), cost + pairs[c][0])
+                
+                chosen.pop()
+                for d in clashing:
+                    blocked[d] -= 1
+        
+        func_search(list(range(len(names))), math.inf, -math.inf, 0)
+        
+        panel = None
+        if best['panel'] is not None:
+            chosen_by_target = {target_of[c]: c for c in best['panel']}
+            panel = {names[t]: pairs[chosen_by_target[t]][:3] for t in range(len(names))}
+        
+        stats['candidates'] = len(pairs)
+        stats['no_candidates'] = [name for name in names if not candidates[name]]
+        stats['complete'] = stats['nodes'] <= max_nodes
+        stats['time'] = time.time() - start_time
+        
+        if verbose:
+            print("=== Multiplex design ===")
+            print("Targets: {}\nCandidates: {}\nNodes: {}\nPruned: {}\nWall time: {:.2f}s\n"
+                      .format(len(names), len(pairs), stats['nodes'], stats['pruned'], stats['time']))
+            if stats['no_candidates']:
+                print("No candidate pairs for: {} (region too short to hold a primer)"
+                          .format(', '.join(stats['no_candidates'])))
+            elif panel is None:
+                print("No compatible panel among the candidates; try more candidates or a wider "
+                      "multiplex_max_tdiff.")
+            else:
+                print("{:<16}{:>8}  {:<24}{:<24}".format("Target", "Cost", "Forward primer", "Reverse primer"))
+                for name, (cost, fp, rp) in panel.items():
+                    print("{:<16}{:>8.2f}  {:<24}{:<24}"
+                              .format(name, cost, self.func_window(*fp), self.func_window(*rp)))
+                print("\nTotal cost: {}".format(best['cost']))
+        
+        return panel, (best['cost'] if panel is not None else None), stats
+
+'''a cost parameter of PrimerDesign, kept in the instance as _<name>; only'''
+'''these attributes pay for invalidation, other attribute writes stay plain'''
+def cost_parameter(name):
+    attribute = '_' + name
+    
+    def set_parameter(self, value):
+        self.__dict__[attribute] = value
+        if 'cost_cache' in self.__dict__:
+            self.clear_cost_cache()
+    
+    return property(operator.attrgetter(attribute), set_parameter)
+
+for parameter in PrimerDesign.cost_parameters:
+    setattr(PrimerDesign, parameter, cost_parameter(parameter))
+
+'''worker side of PrimerDesign.func_parallel_annealing'''
+'''the PrimerDesign object is handed to each worker process once, at start-up'''
+worker_primer_design = None
+
+def init_annealing_worker(primer_design):
+    global worker_primer_design
+    worker_primer_design = primer_design
+
+def run_annealing_chain(task):
+    seed, trace_dir = task
+    telemetry = AnnealingTelemetry(progress='silent')
+    if trace_dir is not None:
+        telemetry.trace_path = os.path.join(trace_dir, 'chain_{}.npz'.format(seed))
+    
+    start_time = time.time()
+    fp, rp, cost, iterations = worker_primer_design.func_simulated_annealing(seed=seed, verbose=False,
+                                                                             telemetry=telemetry)
+    
+    return {'seed': seed, 'fp': fp, 'rp': rp, 'cost': cost, 'iterations': iterations,
+            'stop_reason': worker_primer_design.stop_reason, 'time': time.time() - start_time}
+
+'''worker side of PrimerDesign.func_parallel_tempering'''
+def run_tempering_replica(task):
+    state, temperature, n_steps, seed = task
+    random.seed(seed)
+    
+    return worker_primer_design.func_fixed_temperature_walk(state, temperature, n_steps)
+
+'''
+===============================================================================
+                      BATCH DESIGN FROM A FASTA FILE
+===============================================================================
+'''
+'''yields (name, sequence) for each record, one record in memory at a time'''
+def read_fasta(path):
+    name = None
+    lines = []
+    
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(lines).lower()
+                name = line[1:].split()[0] if line[1:].strip() else ''
+                lines = []
+            elif name is not None:
+                lines.append(line)
+    
+    if name is not None:
+        yield name, ''.join(lines).lower()
+
+'''region spec: a csv with columns name, fp_start, fp_end, rp_start, rp_end'''
+'''returns {name: (fp_start, fp_end, rp_start, rp_end)}'''
+def read_regions(path):
+    regions = {}
+    
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            regions[row['name']] = (int(row['fp_start']), int(row['fp_end']),
+                                    int(row['rp_start']), int(row['rp_end']))
+    
+    return regions
+
+BATCH_FIELDS = ['name', 'length', 'fp_start', 'fp_length', 'fp', 'rp_start', 'rp_length', 'rp',
+                'cost', 'time', 'error']
+
+'''worker side of design_primers_from_fasta: one target per task'''
+'''the worker's PrimerDesign object is reused, only its template and regions change'''
+'''the record keeps its coordinates; windows holding an N or other code are never used'''
+def design_target(task):
+    name, sequence, region, mode, seed = task
+    row = dict.fromkeys(BATCH_FIELDS, '')
+    row['name'] = name
+    start_time = time.time()
+    
+    try:
+        primer_design = worker_primer_design
+        primer_design.fp_start, primer_design.fp_end, primer_design.rp_start, primer_design.rp_end = region
+        primer_design.set_dna_sequence(sequence, keep_coordinates=True)
+        row['length'] = len(primer_design.dna_sequence)
+        
+        if mode == 'exhaustive':
+            results = primer_design.func_exhaustive_search(top_k=1, verbose=False)
+            if not results:
+                raise ValueError('the fp or rp region is too short to hold a primer')
+            cost, fp, rp = results[0]
+        else:
+            fp, rp, cost, iterations = primer_design.func_simulated_annealing(seed=seed, verbose=False)
+        
+        row['fp_start'], row['fp_length'] = fp
+        row['rp_start'], row['rp_length'] = rp
+        row['fp'] = primer_design.func_window(*fp)
+        row['rp'] = primer_design.func_window(*rp)
+        row['cost'] = cost
+    except Exception as e:
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+    
+    row['time'] = round(time.time() - start_time, 3)
+    
+    return row
+
+'''design one primer pair per FASTA record, using the regions given for it'''
+'''results are written to output_path (.jsonl for JSON lines, otherwise csv)'''
+'''in input order as they finish; at most max_pending records are held at once'''
+'''primer_design supplies the criteria parameters (a default PrimerDesign if None)'''
+def design_primers_from_fasta(fasta_path, regions_path, output_path, primer_design=None,
+                              mode='exhaustive', processes=None, max_pending=None, seed=None,
+                              verbose=True):
+    if primer_design is None:
+        primer_design = PrimerDesign("batch")
+    if processes is None:
+        processes = cpu_count()
+    if max_pending is None:
+        max_pending = 4 * processes
+    if seed is None:
+        seed = random.randrange(2**31)
+    
+    regions = read_regions(regions_path)
+    as_jsonl = output_path.endswith('.jsonl')
+    n_written = 0
+    n_failed = 0
+    start_time = time.time()
+    
+    with open(output_path, 'w', newline='') as out, \
+         Pool(processes, initializer=init_annealing_worker, initargs=(primer_design,)) as pool:
+        if not as_jsonl:
+            writer = csv.DictWriter(out, fieldnames=BATCH_FIELDS)
+            writer.writeheader()
+        
+        pending = deque()
+        
+        '''pending holds rows still being designed, or already-made rows for failures'''
+        def write_next():
+            row = pending.popleft()
+            if not isinstance(row, dict):
+                row = row.get()
+            if as_jsonl:
+                out.write(json.dumps(row) + '\n')
+            else:
+                writer.writerow(row)
+            return row
+        
+        for n, (name, sequence) in enumerate(read_fasta(fasta_path)):
+            region = regions.get(name)
+            if region is None:
+                row = dict.fromkeys(BATCH_FIELDS, '')
+                row['name'] = name
+                row['error'] = 'no region given for this record'
+                pending.append(row)
+            else:
+                pending.append(pool.apply_async(design_target, ((name, sequence, region, mode, seed + n),)))
+            
+            '''wait for the oldest target before reading further'''
+            while len(pending) >= max_pending:
+                row = write_next()
+                n_written += 1
+                n_failed += bool(row['error'])
+                if verbose and n_written % 100 == 0:
+                    print("{} targets done ({:.1f}s)".format(n_written, time.time() - start_time))
+        
+        while pending:
+            row = write_next()
+            n_written += 1
+            n_failed += bool(row['error'])
+    
+    if verbose:
+        print("\n=== Batch design ===")
+        print("Targets: {}\nFailed: {}\nWall time: {:.2f}s\nResults: {}"
+                  .format(n_written, n_failed, time.time() - start_time, output_path))
+    
+    return n_written, n_failed
 
 '''
 ===============================================================================
@@ -410,20 +2097,43 @@ class PrimerDesign(object):
 ===============================================================================
 ===============================================================================
 '''
-# key in DNA sequence here; change fp_start/end and rp_start/end accordingly
-dna_sequence = ''
-my_primer = PrimerDesign("my_primer")
-my_primer.set_dna_sequence(dna_sequence)
+if __name__ == '__main__':
+    # key in DNA sequence here; change fp_start/end and rp_start/end accordingly
+    dna_sequence = ''
+    my_primer = PrimerDesign("my_primer")
+    my_primer.set_dna_sequence(dna_sequence)
+
+    answer = input("(A) calculate cost, (B) simulate annealing, (C) exhaustive search,\n"
+                   "(D) parallel annealing, (E) parallel tempering on all cores\n"
+                   "(F) batch design from a FASTA file or (G) multiplex panel design?\n"
+                   "Choose A/B/C/D/E/F/G: ")
+
+    if answer == "A": # display cost objective function results
+        fwd = input("Type in forward primer: ")
+        rev = input("Type in reverse primer: ")
+        my_primer.cost_objective_function_info(fwd, rev)
+
+    elif answer == "B": # perform simulated annealing
+        my_primer.func_simulated_annealing()
+
+    elif answer == "C": # score every candidate pair, show the best ones
+        my_primer.func_exhaustive_search()
+
+    elif answer == "D": # independent annealing chains, one per core
+        my_primer.func_parallel_annealing()
 
-answer = input("(A) calculate cost or (B) simulate annealing?\nChoose A/B: ")
+    elif answer == "E": # replica exchange between fixed temperatures
+        my_primer.func_parallel_tempering()
 
-if answer == "A": # display cost objective function results
-    fwd = input("Type in forward primer: ")
-    rev = input("Type in reverse primer: ")
-    my_primer.cost_objective_function_info(fwd, rev)
+    elif answer == "F": # one primer pair per FASTA record, written as results come in
+        fasta_path = input("FASTA file: ")
+        regions_path = input("Regions csv (name,fp_start,fp_end,rp_start,rp_end): ")
+        output_path = input("Output file (.csv or .jsonl): ")
+        design_primers_from_fasta(fasta_path, regions_path, output_path, primer_design=my_primer)
 
-elif answer == "B": # perform simulated annealing
-    my_primer.func_simulated_annealing()
+    elif answer == "G": # one compatible pair per target region, all in one tube
+        regions_path = input("Regions csv (name,fp_start,fp_end,rp_start,rp_end): ")
+        my_primer.func_multiplex_design(read_regions(regions_path))
 
-else:
-    print("Invalid input.")
\ No newline at end of file
+    else:
+        print("Invalid input.")
\ No newline at end of file
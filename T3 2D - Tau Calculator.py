@@ -7,15 +7,451 @@ Created on Thu Apr 12 00:58:08 2018
 '''
 ln|T_w - T| - ln|T_w - T_amb| = -(1/tau) * t
 
-1. Extract raw data for first 20s from csv
-2. Plot complicated ln function vs t
+1. Extract raw data from csv
+2. Plot complicated ln function vs t, [choose the region where it is a line]
 3. Compute tau
 4. [Remove outliers]
-5. Write tau vs T_w to txt                                                  '''
+5. Write tau vs T_w, with every intermediate result, to an .npz store       '''
 
+import csv
+import json
+import os
+import shutil
+import socket
+import sys
+import time
+import warnings
+import zipfile
+from contextlib import nullcontext
 from math import log as ln
+from statistics import NormalDist
+from multiprocessing import Pool, cpu_count
+import numpy as np
 from numpy import polyfit
 
+'''=============================== Vectorised transform and regression '''
+'''pads runs of different lengths into one array, NaN past the end of each run'''
+def pad_runs(runs):
+    width = max(len(run) for run in runs)
+    padded = np.full((len(runs), width), np.nan)
+    for i, run in enumerate(runs):
+        padded[i, :len(run)] = run
+    
+    return padded
+
+'''ln|T_w - T| - ln|T_w - T_amb| for every reading of every run at once
+   T is (runs, samples); T_w and T_amb hold one value per run
+   where a log is undefined (T = T_w, or T_w = T_amb) the value is ln(0.001)
+   as before; returns the values and the mask of those readings'''
+def log_transform(T, T_w, T_amb, floor=0.001):
+    T_w = np.asarray(T_w, dtype=float).reshape(-1, 1)
+    T_amb = np.asarray(T_amb, dtype=float).reshape(-1, 1)
+    rise = np.abs(T_w - np.asarray(T, dtype=float))
+    span = np.abs(T_w - T_amb)
+    
+    invalid = (rise == 0) | (span == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.log(rise) - np.log(span)
+    values[invalid] = np.log(floor)
+    
+    return values, invalid
+
+'''least-squares line through each row of (x, y), NaN entries left out
+   closed form over the centred sums, so every run is fitted in one pass
+   returns one gradient and one y-intercept per row'''
+def fit_lines(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = valid.sum(axis=-1)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = np.where(valid, x, 0).sum(axis=-1) / n
+        y_mean = np.where(valid, y, 0).sum(axis=-1) / n
+        dx = np.where(valid, x - x_mean[..., None], 0)
+        dy = np.where(valid, y - y_mean[..., None], 0)
+        grad = (dx * dy).sum(axis=-1) / (dx * dx).sum(axis=-1)
+    y_int = y_mean - grad * x_mean
+    
+    return grad, y_int
+
+'''R^2 of the line (grad, y_int) through each row of (x, y), NaN entries left out'''
+def r_squared(x, y, grad, y_int):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residuals = np.where(valid, y - (grad[..., None]*x + y_int[..., None]), 0)
+        y_mean = np.where(valid, y, 0).sum(axis=-1) / valid.sum(axis=-1)
+        spread = np.where(valid, y - y_mean[..., None], 0)
+        return 1 - (residuals**2).sum(axis=-1) / (spread**2).sum(axis=-1)
+
+'''=============================================== Choosing the fit window '''
+'''the log curve is only a line while the exponential holds: early readings
+   lag and late ones are lost in noise once T is close to T_w
+   for each row of (x, y) (NaN-padded runs), every window of each length in
+   window_lengths is tried at every start; a window's slope and R^2 come from
+   differences of cumulative sums of x, y, x^2, xy and y^2, so each costs O(1)
+   by default the lengths are a ladder growing by 25% from min_points to the
+   longest run, which keeps a run of n readings to O(n log n)
+   the chosen window is the longest one with R^2 >= min_r2 and a falling line
+   (the best R^2 among those of that length); if none reaches min_r2, the one
+   with the best R^2
+   returns start and stop indices, gradient, y-intercept and R^2, one per row'''
+def select_fit_windows(x, y, min_points=5, window_lengths=None, min_r2=0.98):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    runs, width = x.shape
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = valid.sum(axis=1)
+    
+    '''centre each run so the cumulative sums keep their precision'''
+    with np.errstate(invalid='ignore'):
+        x0 = np.where(valid, x, 0).sum(axis=1) / np.maximum(n, 1)
+        y0 = np.where(valid, y, 0).sum(axis=1) / np.maximum(n, 1)
+    dx = np.where(valid, x - x0[:, None], 0)
+    dy = np.where(valid, y - y0[:, None], 0)
+    zero = np.zeros((runs, 1))
+    sums = {name: np.concatenate([zero, np.cumsum(values, axis=1)], axis=1)
+            for name, values in [('x', dx), ('y', dy), ('xx', dx*dx), ('xy', dx*dy), ('yy', dy*dy),
+                                 ('n', valid.astype(float))]}
+    
+    if window_lengths is None:
+        window_lengths = [min_points]
+        while window_lengths[-1] < width:
+            window_lengths.append(min(width, max(window_lengths[-1] + 1, int(window_lengths[-1] * 1.25))))
+    
+    best_meets = np.zeros(runs, dtype=bool)
+    best_length = np.zeros(runs, dtype=int)
+    best_r2 = np.full(runs, -np.inf)
+    best_start = np.zeros(runs, dtype=int)
+    best_stop = np.zeros(runs, dtype=int)
+    best_grad = np.full(runs, np.nan)
+    best_y_int = np.full(runs, np.nan)
+    rows = np.arange(runs)
+    
+    for w in window_lengths:
+        if w > width or w < 2:
+            continue
+        
+        '''every window [start, start+w) of every run at once'''
+        window = {name: c[:, w:] - c[:, :-w] for name, c in sums.items()}
+        sxx = window['n']*window['xx'] - window['x']**2
+        sxy = window['n']*window['xy'] - window['x']*window['y']
+        syy = window['n']*window['yy'] - window['y']**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grad = sxy / sxx
+            r2 = np.where(syy > 0, sxy**2 / (sxx*syy), 1.)
+        r2 = np.where((window['n'] == w) & (sxx > 0) & (grad < 0), r2, -np.inf)
+        
+        start = np.argmax(r2, axis=1)
+        r2 = r2[rows, start]
+        meets = r2 >= min_r2
+        length = np.where(meets, w, 0)
+        
+        better = (meets & ~best_meets) | ((meets == best_meets) & ((length > best_length) |
+                                          ((length == best_length) & (r2 > best_r2))))
+        better &= np.isfinite(r2)
+        
+        g = grad[rows, start]
+        sx, sy = window['x'][rows, start], window['y'][rows, start]
+        best_meets = np.where(better, meets, best_meets)
+        best_length = np.where(better, length, best_length)
+        best_r2 = np.where(better, r2, best_r2)
+        best_start = np.where(better, start, best_start)
+        best_grad = np.where(better, g, best_grad)
+        best_y_int = np.where(better, y0 + (sy - g*sx)/w - g*x0, best_y_int)
+        best_stop = np.where(better, start + w, best_stop)
+    
+    return best_start, best_stop, best_grad, best_y_int, best_r2
+
+'''================================================= Confidence intervals '''
+'''the line fitted to each row of (x, y) again on resampled readings, for all
+   rows and resamples in one batched fit_lines
+   'bootstrap': n_resamples draws with replacement, as one index matrix per
+   block of rows; 'jackknife': every leave-one-out fit, from the row's sums
+   less each reading (NaN for readings outside the row)
+   starts and stops limit each row to its fit window (default: all readings,
+   which must be a NaN-padded prefix); returns gradients and y-intercepts,
+   one row of resamples per row of x'''
+def resample_lines(x, y, method='bootstrap', n_resamples=2000, starts=None, stops=None, seed=0,
+                   max_block=4000000):
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    runs, width = x.shape
+    valid = ~(np.isnan(x) | np.isnan(y))
+    if starts is None:
+        starts = np.zeros(runs, dtype=int)
+        stops = valid.sum(axis=1)
+    starts = np.asarray(starts)
+    lengths = np.asarray(stops) - starts
+    
+    if method == 'jackknife':
+        columns = np.arange(width)
+        inside = valid & (columns >= starts[:, None]) & (columns < starts[:, None] + lengths[:, None])
+        x0 = np.where(inside, x, 0).sum(axis=1) / lengths
+        y0 = np.where(inside, y, 0).sum(axis=1) / lengths
+        dx = np.where(inside, x - x0[:, None], 0)
+        dy = np.where(inside, y - y0[:, None], 0)
+        sx, sy = dx.sum(axis=1)[:, None], dy.sum(axis=1)[:, None]
+        sxx, sxy = (dx*dx).sum(axis=1)[:, None], (dx*dy).sum(axis=1)[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grads, y_ints = line_from_sums(lengths[:, None] - 1, sx - dx, sy - dy, sxx - dx*dx, sxy - dx*dy,
+                                           x0[:, None], y0[:, None])
+        return np.where(inside, grads, np.nan), np.where(inside, y_ints, np.nan)
+    
+    rng = np.random.default_rng(seed)
+    grads = np.empty((runs, n_resamples))
+    y_ints = np.empty((runs, n_resamples))
+    longest = max(int(lengths.max(initial=1)), 1)
+    block = max(1, max_block // (n_resamples * longest))
+    
+    for b in range(0, runs, block):
+        rows = slice(b, b+block)
+        length = lengths[rows, None, None]
+        index = starts[rows, None, None] + (rng.random((len(length), n_resamples, longest)) * length).astype(int)
+        index = np.minimum(index, width - 1)
+        drawn = np.arange(longest) < length
+        x_drawn = np.where(drawn, np.take_along_axis(x[rows, None, :], index, axis=2), np.nan)
+        y_drawn = np.where(drawn, np.take_along_axis(y[rows, None, :], index, axis=2), np.nan)
+        grads[rows], y_ints[rows] = fit_lines(x_drawn, y_drawn)
+    
+    return grads, y_ints
+
+'''confidence interval at level from the resampled values of a statistic
+   (last axis): percentiles for 'bootstrap', estimate +- z * jackknife
+   standard error for 'jackknife'; returns the low and high ends'''
+def interval(resampled, estimate, method='bootstrap', level=0.95):
+    alpha = (1 - level) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if method == 'bootstrap':
+            low, high = np.nanpercentile(resampled, [100*alpha, 100*(1-alpha)], axis=-1)
+            return low, high
+        
+        k = np.isfinite(resampled).sum(axis=-1)
+        mean = np.nanmean(resampled, axis=-1)
+        error = np.sqrt((k - 1) / k * np.nansum((resampled - mean[..., None])**2, axis=-1))
+    z = NormalDist().inv_cdf(1 - alpha)
+    
+    return estimate - z*error, estimate + z*error
+
+'''=================================================== Streaming the csv '''
+'''one row of ;-separated numbers; a blank row (or one of only ;) gives []'''
+def parse_row(line):
+    text = line.strip().strip(';')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(text, sep=';')
+        except DeprecationWarning:
+            raise ValueError('could not parse row: {!r}'.format(line[:80]))
+
+'''yields (time, temperature) arrays for one T_w set at a time
+   the file is read chunk_size characters at a time, so memory is bounded by
+   one set however long the logging session; blank rows between sets are skipped'''
+def read_runs(path, chunk_size=1 << 20):
+    time_row = None
+    tail = []
+    
+    with open(path, 'r') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk and '\n' not in chunk:
+                tail.append(chunk)
+                continue
+            
+            lines = (''.join(tail) + chunk).split('\n')
+            tail = [lines.pop()] if chunk else []
+            
+            for line in lines:
+                row = parse_row(line)
+                if row.size == 0:
+                    continue
+                if time_row is None:
+                    time_row = row
+                else:
+                    yield time_row, row
+                    time_row = None
+            
+            if not chunk:
+                break
+
+'''groups the sets from read_runs into lists of up to batch_size, which are'''
+'''transformed and fitted together'''
+def read_run_batches(path, batch_size=256, chunk_size=1 << 20):
+    times = []
+    temps = []
+    for time_row, temp_row in read_runs(path, chunk_size):
+        times.append(time_row)
+        temps.append(temp_row)
+        if len(times) == batch_size:
+            yield times, temps
+            times = []
+            temps = []
+    
+    if times:
+        yield times, temps
+
+'''===================================================== Outlier removal '''
+'''     dist from regr line = sqrt( vector^2 - projection^2 )
+
+        projection, p = proj matrix, P * vector, b
+        P = [1 grad]^T * [1 grad] / [1 grad] * [1 grad]^T
+          = [ 1  g  ]
+            [ g g^2 ] / (g^2 + 1)
+        b = [x y+c]^T
+        Pb = [x+gy+gc   g(x+gy+gc)]^T   /   (g^2+1)              '''
+
+def dist_from_regr(g, c, x, y):
+    x_proj = (x + g*y) / (1 + g**2)
+    y_proj = g * x_proj + c
+    distance = ((x-x_proj)**2 + (y-y_proj)**2)**0.5
+    return distance
+
+'''line through points whose (centred) sums of x, y, x^2 and xy are given'''
+'''x0, y0 are the values the sums were centred on'''
+def line_from_sums(n, sx, sy, sxx, sxy, x0=0., y0=0.):
+    grad = (n*sxy - sx*sy) / (n*sxx - sx**2)
+    y_int = y0 + (sy - grad*sx) / n - grad*x0
+    
+    return grad, y_int
+
+'''removes the num_outliers points furthest from the regression line, one at a
+   time, refitting after each removal
+   the fit is kept as running sums, so a removal only subtracts one point and
+   one vectorised pass finds the next furthest point
+   returns the mask of points kept, the (index, distance) of each point removed
+   in order, and the final gradient and y-intercept'''
+def remove_outliers(x, y, num_outliers):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x0 = x.mean()
+    y0 = y.mean()
+    dx = x - x0
+    dy = y - y0
+    
+    n = len(x)
+    sx, sy, sxx, sxy = dx.sum(), dy.sum(), (dx*dx).sum(), (dx*dy).sum()
+    grad, y_int = line_from_sums(n, sx, sy, sxx, sxy, x0, y0)
+    
+    keep = np.ones(n, dtype=bool)
+    removed = []
+    for k in range(num_outliers):
+        dist = np.where(keep, dist_from_regr(grad, y_int, x, y), -np.inf)
+        m = int(np.argmax(dist))
+        keep[m] = False
+        removed.append((m, dist[m]))
+        
+        n -= 1
+        sx -= dx[m]
+        sy -= dy[m]
+        sxx -= dx[m]**2
+        sxy -= dx[m]*dy[m]
+        grad, y_int = line_from_sums(n, sx, sy, sxx, sxy, x0, y0)
+    
+    return keep, removed, (grad, y_int)
+
+'''robust estimators: each returns its gradient, y-intercept and the mask of'''
+'''inliers, the points within cutoff robust standard deviations (1.4826 MAD)'''
+'''of its line, so outliers are found without choosing how many to remove'''
+def robust_inliers(residuals, cutoff=2.5):
+    scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+    if scale == 0:
+        return np.abs(residuals) <= np.finfo(float).eps * np.abs(residuals).max(initial=1.)
+    return np.abs(residuals) <= cutoff * scale
+
+'''median of the slopes between pairs of points; above max_pairs pairs, a random
+   sample of max_pairs of them is used'''
+def theil_sen(x, y, cutoff=2.5, max_pairs=1000000, seed=0):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    
+    if n*(n-1)//2 <= max_pairs:
+        i, j = np.triu_indices(n, k=1)
+    else:
+        rng = np.random.default_rng(seed)
+        i = rng.integers(0, n, max_pairs)
+        j = rng.integers(0, n, max_pairs)
+    i, j = i[x[i] != x[j]], j[x[i] != x[j]]
+    
+    grad = np.median((y[j] - y[i]) / (x[j] - x[i]))
+    y_int = np.median(y - grad*x)
+    
+    return grad, y_int, robust_inliers(y - (grad*x + y_int), cutoff)
+
+'''Huber regression by iteratively reweighted least squares; points further'''
+'''than k robust standard deviations from the line are down-weighted'''
+def huber(x, y, k=1.345, cutoff=2.5, max_iterations=50, tol=1e-10):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    grad, y_int = fit_lines(x, y)
+    
+    for iteration in range(max_iterations):
+        residuals = y - (grad*x + y_int)
+        scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        if scale == 0:
+            break
+        w = np.minimum(1., k*scale / np.maximum(np.abs(residuals), 1e-300))
+        
+        sw = w.sum()
+        x_mean = (w*x).sum() / sw
+        y_mean = (w*y).sum() / sw
+        new_grad = (w*(x - x_mean)*(y - y_mean)).sum() / (w*(x - x_mean)**2).sum()
+        new_y_int = y_mean - new_grad*x_mean
+        
+        converged = abs(new_grad - grad) <= tol*(1 + abs(grad)) and abs(new_y_int - y_int) <= tol*(1 + abs(y_int))
+        grad, y_int = new_grad, new_y_int
+        if converged:
+            break
+    
+    return grad, y_int, robust_inliers(y - (grad*x + y_int), cutoff)
+
+'''RANSAC: n_trials lines through random pairs of points are scored together;
+   the line with most points within threshold (by default cutoff robust
+   standard deviations of the Theil-Sen residuals) wins, and is refitted by
+   least squares on those points; above max_scored points, trials are scored
+   on a random sample of max_scored of them'''
+def ransac(x, y, n_trials=500, threshold=None, cutoff=2.5, seed=0, block_size=256, max_scored=5000):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    rng = np.random.default_rng(seed)
+    
+    if threshold is None:
+        grad, y_int, inliers = theil_sen(x, y, cutoff, seed=seed)
+        residuals = y - (grad*x + y_int)
+        threshold = cutoff * 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+    
+    pairs = rng.integers(0, len(x), (n_trials, 2))
+    pairs = pairs[x[pairs[:, 0]] != x[pairs[:, 1]]]
+    x1, x2 = x[pairs[:, 0]], x[pairs[:, 1]]
+    y1, y2 = y[pairs[:, 0]], y[pairs[:, 1]]
+    grads = (y2 - y1) / (x2 - x1)
+    y_ints = y1 - grads*x1
+    
+    '''inlier count (then smaller residual sum) of each trial, block by block'''
+    scored = np.arange(len(x))
+    if len(x) > max_scored:
+        scored = rng.choice(len(x), max_scored, replace=False)
+    x_s, y_s = x[scored], y[scored]
+    counts = np.empty(len(grads), dtype=int)
+    spread = np.empty(len(grads))
+    for b in range(0, len(grads), block_size):
+        residuals = np.abs(y_s[None, :] - (grads[b:b+block_size, None]*x_s[None, :] + y_ints[b:b+block_size, None]))
+        within = residuals <= threshold
+        counts[b:b+block_size] = within.sum(axis=1)
+        spread[b:b+block_size] = np.where(within, residuals, 0).sum(axis=1)
+    best = np.lexsort((spread, -counts))[0]
+    
+    inliers = np.abs(y - (grads[best]*x + y_ints[best])) <= threshold
+    grad, y_int = fit_lines(x[inliers], y[inliers])
+    
+    return grad, y_int, np.abs(y - (grad*x + y_int)) <= threshold
+
+ROBUST_METHODS = {'ransac': ransac, 'huber': huber, 'theil-sen': theil_sen}
+
 '''============================================== Reading raw data from csv '''
 T_amb = [26.375, 26.687, 28.312, 25.562, 28.312, 27.062, 31.125, 31.750, 
          28.625, 29.687, 26.375, 28.062, 30.125, 25.625, 27.250, 29.687, 
@@ -30,124 +466,489 @@ T_w = [11.8, 11.8, 12.6, 12.6, 12.6, 13.2, 13.3, 13.3, 14.3, 14.3, 14.3, 16.0,
        43.9, 44.3, 46.3, 46.6, 47.0, 48.5, 48.8, 49.1, 50.1, 50.4, 50.9, 51.1,
        51.4, 51.7, 51.9, 52.3, 56.2, 56.7, 56.9, 57.4]
 
-data = 'directory to csv file with temp vs time data'
-f = open(data, 'r')
-print('\nReading data from csv file.')
-print('Directory:\n{}\n'.format(data))
+'''=================================================== Fitting one file '''
+TABLE_FIELDS = ['run', 'T_w', 'T_amb', 'samples', 'invalid', 'fit_start', 'fit_stop', 'r2',
+                'gradient', 'y_intercept', 'tau', 'tau_low', 'tau_high']
+CURVE_FIELDS = ['times', 'temps', 'log_values']
 
-line = f.readline()
-i = 0
-all_results = []
-#each entry: [T_w, T_amb, list of x values, list of y values]
+'''transforms and fits every T_w set in the csv at path, batch_size sets at a
+   time; T_w and T_amb give the temperatures of each set in file order
+   fit_window 'all' fits every reading of a set, 'auto' only the readings
+   chosen by select_fit_windows (min_r2 is passed on to it)
+   confidence 'bootstrap' or 'jackknife' gives each tau an interval at
+   confidence_level (tau_low, tau_high are NaN with None)
+   with curves_path, the raw and transformed curves of each batch are written
+   there as they are produced, as NaN-padded rows (CURVE_FIELDS) in the store
+   format (see copy_curves), so they are never all in memory at once
+   returns a table: a dict of arrays, one entry per set (see TABLE_FIELDS)'''
+def process_file(path, T_w, T_amb, batch_size=256, fit_window='all', min_r2=0.98, confidence=None,
+                 confidence_level=0.95, n_resamples=2000, curves_path=None, verbose=True):
+    columns = {field: [] for field in TABLE_FIELDS}
+    first = 0
+    
+    #each loop reads the time and temp data for up to batch_size T_w sets,
+    #transforms them into the logarithm and fits every set at once
+    with open_store_file(curves_path) if curves_path is not None else nullcontext() as curves:
+        for batch, (times, temps) in enumerate(read_run_batches(path, batch_size)):
+            if first + len(times) > len(T_w):
+                raise ValueError('{} has more T_w sets than the {} temperatures given'.format(path, len(T_w)))
+            run_T_w = np.array(T_w[first:first+len(times)], dtype=float)
+            run_T_amb = np.array(T_amb[first:first+len(times)], dtype=float)
+            temp_val = pad_runs(temps)
+            y_val, invalid = log_transform(temp_val, run_T_w, run_T_amb)
+            
+            if verbose:
+                for i, j in zip(*np.nonzero(invalid)):
+                    print('ValueError at T = {}'.format(temps[i][j]))
+                    print('Occurred for T_w = {}, T_amb = {}'.format(run_T_w[i], run_T_amb[i]))
+            
+            x_val = pad_runs(times)
+            samples = np.array([len(run) for run in temps])
+            if fit_window == 'auto':
+                starts, stops, grads, y_ints, r2 = select_fit_windows(x_val, y_val, min_r2=min_r2)
+            else:
+                grads, y_ints = fit_lines(x_val, y_val)
+                starts, stops = np.zeros(len(times), dtype=int), samples
+                r2 = r_squared(x_val, y_val, grads, y_ints)
+            
+            if confidence is not None:
+                resampled, _ = resample_lines(x_val, y_val, confidence, n_resamples, starts, stops)
+                tau_low, tau_high = interval(-1 / resampled, -1 / grads, confidence, confidence_level)
+            else:
+                tau_low = tau_high = np.full(len(times), np.nan)
+            
+            columns['run'].append(np.arange(first, first+len(times)))
+            columns['T_w'].append(run_T_w)
+            columns['T_amb'].append(run_T_amb)
+            columns['samples'].append(samples)
+            columns['invalid'].append(invalid.sum(axis=1))
+            columns['fit_start'].append(starts)
+            columns['fit_stop'].append(stops)
+            columns['r2'].append(r2)
+            columns['gradient'].append(grads)
+            columns['y_intercept'].append(y_ints)
+            columns['tau'].append(-1 / grads)
+            columns['tau_low'].append(tau_low)
+            columns['tau_high'].append(tau_high)
+            if curves is not None:
+                for field, block in zip(CURVE_FIELDS, (x_val, temp_val, y_val)):
+                    write_entry(curves, CURVE_ENTRY.format(field, batch), block)
+            first += len(times)
+    
+    return {field: np.concatenate(values) if values else np.empty(0) for field, values in columns.items()}
 
-#each while loop reads the time and temp data for one T_w set
-while line != '':
-    x_val = []
-    y_val = []
+'''============================================== Batch mode: manifest csv '''
+'''the manifest has one row per T_w set: file, T_w, T_amb, with the sets of
+   each file in file order; relative paths are taken from the manifest's folder
+   returns {path: (T_w list, T_amb list)} in manifest order'''
+def read_manifest(manifest_path):
+    folder = os.path.dirname(os.path.abspath(manifest_path))
+    files = {}
     
-    time = line.strip().split(';')
+    with open(manifest_path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            path = os.path.join(folder, row['file'].strip())
+            T_w_list, T_amb_list = files.setdefault(path, ([], []))
+            T_w_list.append(float(row['T_w']))
+            T_amb_list.append(float(row['T_amb']))
     
-    for elem in time:
-        x_val.append(float(elem))
+    return files
+
+'''worker side of process_manifest: one file per task'''
+def process_manifest_entry(task):
+    path, T_w_list, T_amb_list, options = task
+    try:
+        return path, process_file(path, T_w_list, T_amb_list, verbose=False, **options), None
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+
+'''processes every file in the manifest in a pool of processes and merges the
+   per-set results into one table, with a 'file' column added; files that fail
+   are reported and left out; options are passed on to process_file
+   with curves_path, each worker writes the curves of its file beside it and
+   they are then copied into curves_path, batches numbered on in table order'''
+def process_manifest(manifest_path, processes=None, verbose=True, curves_path=None, **options):
+    files = read_manifest(manifest_path)
+    tasks = [(path, T_w_list, T_amb_list, dict(options, curves_path=None if curves_path is None
+                                               else '{}.{}'.format(curves_path, i)))
+             for i, (path, (T_w_list, T_amb_list)) in enumerate(files.items())]
+    if processes is None:
+        processes = cpu_count()
     
-    line = f.readline()
-    temp = line.strip().split(';')
+    tables = []
+    parts = []
+    with Pool(min(processes, max(len(tasks), 1))) as pool:
+        for task, (path, table, error) in zip(tasks, pool.imap(process_manifest_entry, tasks)):
+            part = task[3]['curves_path']
+            if error is not None:
+                print('Skipped {}: {}'.format(path, error))
+                if part is not None and os.path.exists(part):
+                    os.remove(part)
+                continue
+            table['file'] = np.full(len(table['tau']), path)
+            tables.append(table)
+            parts.append(part)
+            if verbose:
+                print('{}: {} sets, {} invalid readings'.format(path, len(table['tau']), table['invalid'].sum()))
     
-    #compute ln values
-    for elem in temp:
-        try:
-            value = ln(abs(T_w[i] - float(elem))) - ln(abs(T_w[i] - T_amb[i]))
-        except ValueError:
-            print('ValueError at T = {}'.format(elem))
-            print('Occurred for T_w = {}, T_amb = {}'.format(T_w[i], T_amb[i]))
-            value = ln(0.001)
-        y_val.append(value)
+    if curves_path is not None:
+        with open_store_file(curves_path) as curves:
+            batch = 0
+            for part in parts:
+                batch = copy_curves(curves, part, batch)
+                os.remove(part)
     
-    dataset = [x_val, y_val]
-    all_results.append([T_w[i], T_amb[i], dataset])
+    if not tables:
+        return {field: np.empty(0) for field in ['file'] + TABLE_FIELDS}
+    return {field: np.concatenate([table[field] for table in tables]) for field in ['file'] + TABLE_FIELDS}
+
+'''=============================================== Binary result store (.npz) '''
+'''the store is an uncompressed .npz: one .npy per array plus a json 'meta' entry
+   it is written to a temporary file and moved into place, with fixed zip
+   timestamps, so writing the same results again gives the same file
+   np.load reads it as usual; load_store can also memory-map every array
+   curves are kept as one entry per field and batch (CURVE_ENTRY), so they can
+   be written as they are produced and read back one batch at a time'''
+STORE_DATE = (1980, 1, 1, 0, 0, 0)
+CURVE_ENTRY = 'curves/{}/{:08d}'
+
+def open_store_file(path):
+    return zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+'''writes one array into an open store as name.npy'''
+def write_entry(store, name, array):
+    info = zipfile.ZipInfo(name + '.npy', date_time=STORE_DATE)
+    with store.open(info, 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+
+'''copies the curve entries of the store-format file at source into an open
+   store a block at a time, numbering its batches on from first_batch
+   returns the number of the batch after the last one copied'''
+def copy_curves(store, source, first_batch=0):
+    next_batch = first_batch
+    with zipfile.ZipFile(source) as curves:
+        for info in curves.infolist():
+            if not info.filename.startswith('curves/'):
+                continue
+            _, field, batch = info.filename[:-len('.npy')].split('/')
+            batch = first_batch + int(batch)
+            target = zipfile.ZipInfo(CURVE_ENTRY.format(field, batch) + '.npy', date_time=STORE_DATE)
+            with curves.open(info) as f, store.open(target, 'w', force_zip64=True) as g:
+                shutil.copyfileobj(f, g, 1 << 20)
+            next_batch = max(next_batch, batch + 1)
     
-    line = f.readline() #skip blank row
-    line = f.readline()
-    i += 1
+    return next_batch
 
-f.close()
-print('\nData compiled and modified into the complicated logarithm.')
+'''writes arrays and meta to the store at path; with curves, the curve entries
+   of that store-format file are copied in without being read into memory'''
+def save_store(path, arrays, meta, curves=None):
+    temporary = path + '.tmp'
+    with open_store_file(temporary) as store:
+        for name, array in arrays.items():
+            write_entry(store, name, array)
+        if curves is not None:
+            copy_curves(store, curves)
+        write_entry(store, 'meta', np.array(json.dumps(meta, sort_keys=True)))
+    os.replace(temporary, path)
 
-'''====================================================== Performing linreg '''
-linreg_results = []
-#each entry: [T_w, gradient, y-intercept]
+'''returns the arrays of a store and its meta; with mmap, arrays are read-only
+   views of the file, so only the parts used are read'''
+def load_store(path, mmap=True):
+    arrays = {}
+    with zipfile.ZipFile(path) as store, open(path, 'rb') as raw:
+        for info in store.infolist():
+            name = info.filename[:-len('.npy')]
+            if not mmap or info.compress_type != zipfile.ZIP_STORED or name == 'meta':
+                with store.open(info) as f:
+                    arrays[name] = np.lib.format.read_array(f, allow_pickle=False)
+                continue
+            
+            '''the .npy data starts after the zip local header and the .npy header'''
+            raw.seek(info.header_offset)
+            local = raw.read(30)
+            name_length = int.from_bytes(local[26:28], 'little')
+            extra_length = int.from_bytes(local[28:30], 'little')
+            raw.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(raw)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw)
+            if 0 in shape:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=raw.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    
+    meta = json.loads(arrays.pop('meta').item())
+    return arrays, meta
 
-for result in all_results:
-    grad, y_int = polyfit(result[2][0], result[2][1], 1)
-    #print('T_w = {}: gradient {:+.3f}, y-intercept {:+.3f}'.format(result[0], grad, y_int))
-    linreg_results.append([result[0], grad, y_int])
+'''the curves in the arrays of a store, one batch at a time: yields the times,
+   temps and log_values rows of each batch, whose sets follow in table order'''
+def curve_batches(arrays):
+    batch = 0
+    while CURVE_ENTRY.format(CURVE_FIELDS[0], batch) in arrays:
+        yield tuple(arrays[CURVE_ENTRY.format(field, batch)] for field in CURVE_FIELDS)
+        batch += 1
 
-print('\nLinear regression performed for abovementioned logarithm vs time.')
+'''identifies the inputs of an analysis: the size and modification time of
+   each file read (None if missing), and the options used; a store whose meta holds the same
+   fingerprint can be used instead of re-reading and re-fitting the csv'''
+def source_fingerprint(paths, options):
+    files = []
+    for path in paths:
+        if not os.path.exists(path):
+            files.append([os.path.abspath(path), None, None])
+            continue
+        stat = os.stat(path)
+        files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    
+    return {'files': files, 'options': options}
 
-'''========================================================= Determining tau'''
-tau = [(-1/item[1]) for item in linreg_results]
-twater = [item[0] for item in linreg_results]
+'''================================================ Online (live) tau '''
+'''recursive least squares for ln|T_w - T| - ln|T_w - T_amb| = grad*t + y_int,
+   updated in O(1) per reading; tau = -1/grad
+   T_amb defaults to the first reading, t is measured from the first reading
+   forgetting < 1 discounts old readings (1 weighs them all equally)
+   converged is set once tau has changed by less than tol (relative) for
+   patience readings in a row, after at least min_samples readings'''
+class OnlineTau:
+    
+    def __init__(self, T_w, T_amb=None, forgetting=1., tol=0.002, patience=20, min_samples=10, floor=0.001):
+        self.T_w = T_w
+        self.T_amb = T_amb
+        self.forgetting = forgetting
+        self.tol = tol
+        self.patience = patience
+        self.min_samples = min_samples
+        self.floor = floor
+        
+        self.t0 = None
+        self.grad = 0.
+        self.y_int = 0.
+        '''P, the inverse information matrix, starts large: nothing is known yet'''
+        self.p11, self.p12, self.p22 = 1e6, 0., 1e6
+        
+        self.samples = 0
+        self.tau = float('nan')
+        self.steady = 0
+        self.converged = False
+    
+    def update(self, t, T):
+        if self.t0 is None:
+            self.t0 = t
+            if self.T_amb is None:
+                self.T_amb = T
+        t = t - self.t0
+        
+        try:
+            y = ln(abs(self.T_w - T)) - ln(abs(self.T_w - self.T_amb))
+        except ValueError:
+            y = ln(self.floor)
+        
+        '''gain k = P phi / (forgetting + phi' P phi), phi = (t, 1)'''
+        p_phi1 = self.p11*t + self.p12
+        p_phi2 = self.p12*t + self.p22
+        denominator = self.forgetting + t*p_phi1 + p_phi2
+        k1 = p_phi1 / denominator
+        k2 = p_phi2 / denominator
+        
+        error = y - (self.grad*t + self.y_int)
+        self.grad += k1*error
+        self.y_int += k2*error
+        
+        self.p11 = (self.p11 - k1*p_phi1) / self.forgetting
+        self.p12 = (self.p12 - k1*p_phi2) / self.forgetting
+        self.p22 = (self.p22 - k2*p_phi2) / self.forgetting
+        
+        '''convergence: tau steady for patience readings in a row'''
+        tau = -1/self.grad if self.grad < 0 else float('nan')
+        self.samples += 1
+        if self.samples > 1 and abs(tau - self.tau) <= self.tol*abs(tau):
+            self.steady += 1
+        else:
+            self.steady = 0
+        self.tau = tau
+        self.converged = self.samples >= self.min_samples and self.steady >= self.patience
+        
+        return tau
 
-print('\nTau values computed.')
+'''lines from a live source: '-' reads a pipe on stdin, 'tcp://host:port'
+   connects to a socket; anything else is a file, replayed line by line'''
+def open_stream(source):
+    if source == '-':
+        return sys.stdin
+    if source.startswith('tcp://'):
+        host, port = source[len('tcp://'):].rsplit(':', 1)
+        return socket.create_connection((host, int(port))).makefile('r')
+    
+    return open(source, 'r')
 
-'''=================================================== Plot regression line '''
-grad, y_int = polyfit(twater, tau, 1)
-print('\nRegression line calculated for full data set of tau against T_water.')
-print('Gradient: {:.3f}   y-intercept: {:.3f}'.format(grad, y_int))
+'''(time, temperature) samples from lines of time;temperature (or time,temperature)'''
+def read_samples(lines):
+    for line in lines:
+        row = parse_row(line.replace(',', ';'))
+        if row.size == 0:
+            continue
+        if row.size != 2:
+            raise ValueError('expected time;temperature, got {!r}'.format(line[:80]))
+        yield row[0], row[1]
 
-'''=========================== Remove anomalies and re-plot regression line '''
-'''     dist from regr line = sqrt( vector^2 - projection^2 )
+'''replays set number run of a csv in the time row / temperature row format'''
+def replay_set(path, run=0):
+    for i, (times, temps) in enumerate(read_runs(path)):
+        if i == run:
+            return zip(times.tolist(), temps.tolist())
+    raise ValueError('{} has no T_w set {}'.format(path, run))
 
-        projection, p = proj matrix, P * vector, b
-        P = [1 grad]^T * [1 grad] / [1 grad] * [1 grad]^T
-          = [ 1  g  ]
-            [ g g^2 ] / (g^2 + 1)
-        b = [x y+c]^T
-        Pb = [x+gy+gc   g(x+gy+gc)]^T   /   (g^2+1)              '''
+'''feeds samples to an OnlineTau estimator, printing tau every emit_every
+   readings; stops early once tau converges if stop_when_converged
+   replay_speed paces the samples in (sample) time / replay_speed, None for
+   as fast as they come; returns the estimator'''
+def stream_tau(samples, T_w, T_amb=None, emit_every=10, stop_when_converged=True, replay_speed=None,
+               verbose=True, **options):
+    estimator = OnlineTau(T_w, T_amb, **options)
+    last_t = None
+    
+    for t, T in samples:
+        if replay_speed is not None and last_t is not None:
+            time.sleep(max(t - last_t, 0) / replay_speed)
+        last_t = t
+        
+        tau = estimator.update(t, T)
+        if verbose and estimator.samples % emit_every == 0:
+            print('t = {:8.2f}   T = {:7.3f}   tau = {:8.3f}'.format(t, T, tau))
+        if stop_when_converged and estimator.converged:
+            break
+    
+    if verbose:
+        state = 'converged' if estimator.converged else 'not converged'
+        print('\nTau = {:.3f} after {} readings ({}).'.format(estimator.tau, estimator.samples, state))
+    
+    return estimator
 
-def dist_from_regr(g, c, x, y):
-    x_proj = (x + g*y) / (1 + g**2)
-    y_proj = g * x_proj + c
-    distance = ((x-x_proj)**2 + (y-y_proj)**2)**0.5
-    return distance
+if __name__ == '__main__':
+    '''live mode: estimate tau as readings arrive instead of from a finished csv'''
+    live_source = None    #'-' (pipe), 'tcp://host:port' or a file of time;temperature lines
+    live_T_w = 20.0       #water temperature of the live run
+    live_T_amb = None     #None: taken from the first reading
+    
+    if live_source is not None:
+        print('\nEstimating tau live from {}.'.format(live_source))
+        stream_tau(read_samples(open_stream(live_source)), live_T_w, live_T_amb)
+        sys.exit()
+    
+    data = 'directory to csv file with temp vs time data'
+    manifest = None       #csv of file,T_w,T_amb rows: fits every file listed, in parallel
+    batch_size = 256      #T_w sets read and fitted together
+    fit_window = 'all'    #'all' fits every reading; 'auto' finds the straight part of each set
+    confidence = None     #'bootstrap' or 'jackknife': intervals for each tau and the final line
+    confidence_level = 0.95
+    n_resamples = 2000    #bootstrap resamples
+    store = 'npz for writing to'
+    store_curves = True   #also keep the raw and transformed curves in the store, written batch by batch
+    curves_path = store + '.curves' if store_curves else None
+    options = {'batch_size': batch_size, 'fit_window': fit_window, 'confidence': confidence,
+               'confidence_level': confidence_level, 'n_resamples': n_resamples}
+    
+    '''============================== Transforming and fitting each batch of sets'''
+    #a store written from the same files with the same options is used as is
+    if manifest is None:
+        fingerprint = source_fingerprint([data], dict(options, T_w=T_w, T_amb=T_amb, keep_curves=store_curves))
+    else:
+        fingerprint = source_fingerprint([manifest] + list(read_manifest(manifest)),
+                                         dict(options, keep_curves=store_curves))
+    stored_meta = None
+    if os.path.exists(store):
+        table, stored_meta = load_store(store)
+    
+    if stored_meta is not None and stored_meta.get('source') == fingerprint:
+        print('\nResults read from the store, which matches the csv files.')
+        print('Store:\n{}\n'.format(store))
+        #the curves stay on disk and are copied over from the old store
+        table = {name: array for name, array in table.items() if not name.startswith('curves/')}
+        curves_path = store if store_curves else None
+    elif manifest is None:
+        print('\nReading data from csv file.')
+        print('Directory:\n{}\n'.format(data))
+        table = process_file(data, T_w, T_amb, curves_path=curves_path, **options)
+    else:
+        print('\nReading data from the csv files in manifest.')
+        print('Manifest:\n{}\n'.format(manifest))
+        table = process_manifest(manifest, curves_path=curves_path, **options)
+    
+    tau = table['tau'].tolist()
+    twater = table['T_w'].tolist()
+    
+    print('\nData compiled and modified into the complicated logarithm.')
+    print('\nLinear regression performed for abovementioned logarithm vs time.')
+    if fit_window == 'auto':
+        print('\nFit windows chosen: {:.0f} of {:.0f} readings per set on average, mean R^2 {:.4f}.'.format(
+                (table['fit_stop'] - table['fit_start']).mean(), table['samples'].mean(), table['r2'].mean()))
+    print('\nTau values computed.')
+    
+    '''=================================================== Plot regression line '''
+    grad, y_int = polyfit(twater, tau, 1)
+    print('\nRegression line calculated for full data set of tau against T_water.')
+    print('Gradient: {:.3f}   y-intercept: {:.3f}'.format(grad, y_int))
 
-num_outliers = 0      #number of outliers you wish to remove
-
-removed = 0
-while removed < num_outliers:
-    dist_list = []
-    for i in range(len(twater)):
-        dist_list.append(dist_from_regr(grad, y_int, twater[i], tau[i]))
-    m = dist_list.index(max(dist_list))
-    m_twater = twater.pop(m)
-    m_tau = tau.pop(m)
-    print('\n{:.1f},{:.1f} removed for being {:.1f} away from regression line.'.format(
-            m_twater, m_tau, dist_list[m]))
+    '''=========================== Remove anomalies and re-plot regression line '''
+    outlier_method = 'manual' #'manual', or 'ransac', 'huber', 'theil-sen' to find outliers automatically
+    num_outliers = 0      #number of outliers you wish to remove ('manual' only)
+
+    if outlier_method == 'manual':
+        keep, removed, (grad, y_int) = remove_outliers(twater, tau, num_outliers)
+        for m, distance in removed:
+            print('\n{:.1f},{:.1f} removed for being {:.1f} away from regression line.'.format(
+                    twater[m], tau[m], distance))
+            print('New regression line plotted after removing outlier.')
+    else:
+        r_grad, r_y_int, keep = ROBUST_METHODS[outlier_method](twater, tau)
+        print('\nRobust ({}) regression line: gradient {:.3f}   y-intercept {:.3f}'.format(
+                outlier_method, r_grad, r_y_int))
+        for m in np.nonzero(~keep)[0]:
+            print('{:.1f},{:.1f} removed as an outlier.'.format(twater[m], tau[m]))
+
+    num_outliers = int((~keep).sum())
+    twater = [value for value, kept in zip(twater, keep) if kept]
+    tau = [value for value, kept in zip(tau, keep) if kept]
+
+    print('\n========================================================\n\nRESULT\n')
+    print('{} outliers removed from original data.'.format(num_outliers))
     grad, y_int = polyfit(twater, tau, 1)
-    print('New regression line plotted after removing outlier.')
-    removed += 1
-
-print('\n========================================================\n\nRESULT\n')
-print('{} outliers removed from original data.'.format(num_outliers))
-grad, y_int = polyfit(twater, tau, 1)
-print('Final regression line plotted from {} pairs of values.'.format(len(twater)))
-print('Gradient: {:.3f}   y-intercept: {:.3f}'.format(grad, y_int))
-
-'''============================================= Write cleaned data to file '''
-#send data to txt file to settle the remaining manipulations in Excel
-def send_data():
-    sendto = 'txt for writing to'
-    f2 = open(sendto, 'a')
-    for i in range(len(twater)):
-        f2.write('{},{}\n'.format(twater[i], tau[i]))
-    
-    f2.close()
-    print('\nCleaned data set written to text file for further processing.')
-    print('Destination:\n{}'.format(sendto))
-
-#checkpoint to ensure intentional writing
-answer = input('Are you sure you want to write the results to txt? Y/N: ')
-if answer == 'Y' or answer == 'y':
-    send_data()
-else:
-    print('Data not written.')
\ No newline at end of file
+    print('Final regression line plotted from {} pairs of values.'.format(len(twater)))
+    print('Gradient: {:.3f}   y-intercept: {:.3f}'.format(grad, y_int))
+    
+    if confidence is not None:
+        grads, y_ints = resample_lines(twater, tau, confidence, n_resamples)
+        grad_low, grad_high = interval(grads[0], grad, confidence, confidence_level)
+        y_int_low, y_int_high = interval(y_ints[0], y_int, confidence, confidence_level)
+        print('{:.0%} confidence ({}): gradient [{:.3f}, {:.3f}]   y-intercept [{:.3f}, {:.3f}]'.format(
+                confidence_level, confidence, grad_low, grad_high, y_int_low, y_int_high))
+        print('Tau intervals per set are {:.3f} wide on average.'.format(
+                np.nanmean(table['tau_high'] - table['tau_low'])))
+
+    '''============================================== Write results to the store '''
+    #per-set fits (and curves), the cleaned pairs and the final line, in one .npz;
+    #rewriting it replaces the old store rather than adding to it
+    def send_data():
+        arrays = {field: np.array(values) for field, values in table.items()}
+        table.clear()   #lets go of any memory-mapped views of the store before it is replaced
+        arrays['kept'] = np.asarray(keep)
+        arrays['clean_T_w'] = np.array(twater)
+        arrays['clean_tau'] = np.array(tau)
+        arrays['line'] = np.array([grad, y_int])
+        meta = {'source': fingerprint, 'outlier_method': outlier_method, 'num_outliers': num_outliers}
+        save_store(store, arrays, meta, curves=curves_path)
+        
+        print('\nResults and cleaned data set written to the store for further processing.')
+        print('Destination:\n{}'.format(store))
+
+    #checkpoint to ensure intentional writing
+    answer = input('Are you sure you want to write the results to the store? Y/N: ')
+    if answer == 'Y' or answer == 'y':
+        send_data()
+    else:
+        print('Data not written.')
+    if curves_path is not None and curves_path != store:
+        os.remove(curves_path)
\ No newline at end of file